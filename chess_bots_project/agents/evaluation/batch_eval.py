@@ -0,0 +1,63 @@
+"""
+Batched evaluation: scores many positions in one NumPy call
+Positions are encoded as piece planes, a (K, 12, 64) tensor: plane 0-5 are white's pawn, knight, bishop, rook, queen
+and king, planes 6-11 black's, and plane[square] is 1 where such a piece stands (a1 = 0, h8 = 63).
+A batch evaluator is any callable taking a piece plane tensor and returning the K scores in pawns, from white's
+perspective. MaterialPSTEvaluator is the default; a learned model can be plugged in the same way.
+"""
+
+
+import chess
+import numpy as np
+
+from agents.evaluation import eval_func
+from agents.evaluation.piece_square_table import PieceSquareTable
+
+
+NUM_PLANES = 12
+
+
+def plane_index(piece_type: chess.PieceType, color: chess.Color) -> int:
+    return (0 if color == chess.WHITE else 6) + piece_type - 1
+
+
+def board_bitboards(board: chess.Board) -> list:
+    # The 12 piece bitboards of board, in plane order. Cheap to collect per position, see bitboards_to_planes
+    return [board.pieces_mask(piece_type, color) for color in (chess.WHITE, chess.BLACK)
+            for piece_type in chess.PIECE_TYPES]
+
+
+def bitboards_to_planes(bitboards: np.ndarray) -> np.ndarray:
+    """
+    Converts a (K, 12) uint64 array of piece bitboards into (K, 12, 64) piece planes, all positions at once
+    """
+    num_positions = len(bitboards)
+    # little endian bytes, unpacked little bit first: bit i of each bitboard lands on square i
+    as_bytes = np.ascontiguousarray(bitboards, dtype="<u8").view(np.uint8).reshape(num_positions, NUM_PLANES, 8)
+    return np.unpackbits(as_bytes, axis=-1, bitorder="little")
+
+
+def encode_boards(boards: list) -> np.ndarray:
+    # (K, 12, 64) piece planes of a list of boards
+    bitboards = np.array([board_bitboards(board) for board in boards], dtype=np.uint64).reshape(-1, NUM_PLANES)
+    return bitboards_to_planes(bitboards)
+
+
+class MaterialPSTEvaluator:
+    """
+    Material + piece-square evaluation of a batch, as a dot product of the planes with a (12, 64) weight table.
+    Same scores as eval_func.evaluate for positions that are not checkmate or stalemate
+    """
+    def __init__(self):
+        self.weights = np.zeros((NUM_PLANES, 64), dtype=np.float64)
+        for color in chess.COLORS:
+            sign = 1 if color == chess.WHITE else -1
+            for piece_type in chess.PIECE_TYPES:
+                for square in chess.SQUARES:
+                    # piece square table values for black are already negated
+                    self.weights[plane_index(piece_type, color), square] = (
+                        sign * eval_func.PIECE_VALUES[piece_type] + PieceSquareTable.read(piece_type, color, square))
+
+    def __call__(self, planes: np.ndarray) -> np.ndarray:
+        centipawns = planes.reshape(len(planes), -1) @ self.weights.reshape(-1)
+        return centipawns / eval_func.PAWN_ADVANTAGE
@@ -0,0 +1,114 @@
+"""
+Bitboard evaluation
+Drop-in replacement for eval_func.evaluate working on the raw integer bitboards of the board (board.pawns,
+board.occupied_co, ...) instead of SquareSets. On top of material and piece-square tables it scores:
+* mobility: squares attacked by each knight, bishop, rook and queen that are not occupied by its own pieces
+* king safety: squares next to the enemy king (and the king's square) attacked by those pieces
+Material + piece-square terms are the same as eval_func's, read from tables indexed by each byte of a piece bitboard.
+"""
+
+
+import chess
+
+from agents.evaluation import eval_func
+from agents.evaluation.piece_square_table import PieceSquareTable
+
+
+# centipawns per attacked square, see module docstring
+MOBILITY_WEIGHTS = {chess.KNIGHT: 4, chess.BISHOP: 4, chess.ROOK: 2, chess.QUEEN: 1}
+KING_ATTACK_WEIGHTS = {chess.KNIGHT: 6, chess.BISHOP: 6, chess.ROOK: 8, chess.QUEEN: 12}
+
+
+def _build_byte_tables():
+    # For each piece type and color, 8 * 256 entries: entry (byte_index << 8) | byte is the material + piece-square
+    # score (white's perspective) of pieces standing on the squares of the bits set in byte, at rank byte_index
+    tables = {}
+    for piece_type in chess.PIECE_TYPES:
+        for color in chess.COLORS:
+            sign = 1 if color == chess.WHITE else -1
+            table = [0] * (8 * 256)
+            for byte_index in range(8):
+                base = byte_index << 8
+                for byte in range(1, 256):
+                    # add the lowest set bit to the entry of the byte without it
+                    low_bit = (byte & -byte).bit_length() - 1
+                    square = 8 * byte_index + low_bit
+                    # piece square table values for black are already negated
+                    table[base | byte] = (table[base | (byte & (byte - 1))] + sign * eval_func.PIECE_VALUES[piece_type]
+                                          + PieceSquareTable.read(piece_type, color, square))
+            tables[(piece_type, color)] = table
+    return tables
+
+
+MATERIAL_PST_TABLES = _build_byte_tables()
+
+
+def evaluate(position: chess.Board, pawn_structure=False):
+    # Same conventions as eval_func.evaluate: pawns, from white's perspective, no draw rules checked
+    if position.is_checkmate():
+        return eval_func.CHECKMATE_SCORE if position.turn == chess.BLACK else -eval_func.CHECKMATE_SCORE
+    elif position.is_stalemate():
+        return 0
+    return static_evaluate(position, pawn_structure)
+
+
+def static_evaluate(position: chess.Board, pawn_structure=False):
+    # evaluate without the checkmate and stalemate tests
+    score = material_pst_score(position) + activity_score(position)
+    if pawn_structure:
+        score += eval_func.pawn_structure_score(position) + eval_func.pawn_shield_score(position)
+    return score / eval_func.PAWN_ADVANTAGE
+
+
+def material_pst_score(position: chess.Board):
+    # Same as eval_func.material_score + eval_func.piece_position_score, one table lookup per non-empty rank
+    score = 0
+    for color in chess.COLORS:
+        occupied = position.occupied_co[color]
+        for piece_type, piece_mask in ((chess.PAWN, position.pawns), (chess.KNIGHT, position.knights),
+                                       (chess.BISHOP, position.bishops), (chess.ROOK, position.rooks),
+                                       (chess.QUEEN, position.queens), (chess.KING, position.kings)):
+            bitboard = piece_mask & occupied
+            table = MATERIAL_PST_TABLES[(piece_type, color)]
+            base = 0
+            while bitboard:
+                if bitboard & 0xFF:
+                    score += table[base | (bitboard & 0xFF)]
+                bitboard >>= 8
+                base += 256
+    return score
+
+
+def activity_score(position: chess.Board):
+    """
+    Mobility and king safety in centipawns from white's perspective. Attacks come from python-chess's
+    precomputed attack tables, indexed by the occupancy of the piece's lines
+    """
+    occupied = position.occupied
+    score = 0
+    for color in chess.COLORS:
+        own = position.occupied_co[color]
+        enemy_king = position.king(not color)
+        king_zone = 0 if enemy_king is None else chess.BB_KING_ATTACKS[enemy_king] | chess.BB_SQUARES[enemy_king]
+        color_score = 0
+        for square in chess.scan_forward(position.knights & own):
+            attacks = chess.BB_KNIGHT_ATTACKS[square]
+            color_score += (MOBILITY_WEIGHTS[chess.KNIGHT] * (attacks & ~own).bit_count()
+                            + KING_ATTACK_WEIGHTS[chess.KNIGHT] * (attacks & king_zone).bit_count())
+        for square in chess.scan_forward(position.bishops & own):
+            attacks = chess.BB_DIAG_ATTACKS[square][chess.BB_DIAG_MASKS[square] & occupied]
+            color_score += (MOBILITY_WEIGHTS[chess.BISHOP] * (attacks & ~own).bit_count()
+                            + KING_ATTACK_WEIGHTS[chess.BISHOP] * (attacks & king_zone).bit_count())
+        for square in chess.scan_forward(position.rooks & own):
+            attacks = (chess.BB_RANK_ATTACKS[square][chess.BB_RANK_MASKS[square] & occupied]
+                       | chess.BB_FILE_ATTACKS[square][chess.BB_FILE_MASKS[square] & occupied])
+            color_score += (MOBILITY_WEIGHTS[chess.ROOK] * (attacks & ~own).bit_count()
+                            + KING_ATTACK_WEIGHTS[chess.ROOK] * (attacks & king_zone).bit_count())
+        for square in chess.scan_forward(position.queens & own):
+            attacks = (chess.BB_DIAG_ATTACKS[square][chess.BB_DIAG_MASKS[square] & occupied]
+                       | chess.BB_RANK_ATTACKS[square][chess.BB_RANK_MASKS[square] & occupied]
+                       | chess.BB_FILE_ATTACKS[square][chess.BB_FILE_MASKS[square] & occupied])
+            color_score += (MOBILITY_WEIGHTS[chess.QUEEN] * (attacks & ~own).bit_count()
+                            + KING_ATTACK_WEIGHTS[chess.QUEEN] * (attacks & king_zone).bit_count())
+        score += color_score if color == chess.WHITE else -color_score
+    return score
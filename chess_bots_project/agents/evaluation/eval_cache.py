@@ -0,0 +1,78 @@
+"""
+Evaluation cache
+Fixed-size, preallocated table of static evaluations keyed by Zobrist hash. Lossy: an entry is simply overwritten
+by the next position mapping to the same slot, so lookups and stores are O(1) with no bookkeeping.
+HashBoard.evaluate goes through the cache of its hasher (see for_hasher), so every agent evaluating through
+HashBoard uses it, and bots sharing a hasher share their cache too.
+"""
+
+
+import weakref
+
+
+def power_of_two_entries(size_mb, entry_bytes) -> int:
+    # Largest power of two number of entries fitting in the memory budget, so a table's index is key & mask
+    max_entries = max(1, int(size_mb * (1 << 20)) // entry_bytes)
+    return 1 << (max_entries.bit_length() - 1)
+
+
+class EvalCache:
+    ENTRY_BYTES = 16  # one key word and one evaluation
+    DEFAULT_SIZE_MB = 4
+
+    _hasher_caches = weakref.WeakKeyDictionary()  # ZobristHash -> EvalCache, see for_hasher
+
+    def __init__(self, size_mb=DEFAULT_SIZE_MB):
+        """
+        size_mb (float) : memory budget of the cache
+        """
+        self._num_entries = power_of_two_entries(size_mb, self.ENTRY_BYTES)
+        self._index_mask = self._num_entries - 1
+        self._key_buffer = bytearray(8 * self._num_entries)
+        self._keys = memoryview(self._key_buffer).cast('Q')
+        self._values = memoryview(bytearray(8 * self._num_entries)).cast('d')
+        self._num_filled = 0
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def for_hasher(cls, hasher) -> "EvalCache":
+        # The cache for positions hashed by hasher, made on first use. Keys of different hashers don't match,
+        # so each hasher gets its own
+        cache = cls._hasher_caches.get(hasher)
+        if cache is None:
+            cache = cls()
+            cls._hasher_caches[hasher] = cache
+        return cache
+
+    def get(self, hash_key: int) -> float | None:
+        index = hash_key & self._index_mask
+        # key 0 marks an empty slot (a position hashing to 0 is never cached)
+        if self._keys[index] == hash_key and hash_key:
+            self.hits += 1
+            return self._values[index]
+        self.misses += 1
+        return None
+
+    def add(self, hash_key: int, evaluation: float):
+        index = hash_key & self._index_mask
+        if not self._keys[index]:
+            self._num_filled += 1
+        self._keys[index] = hash_key
+        self._values[index] = evaluation
+
+    def size(self):
+        return self._num_filled
+
+    def capacity(self):
+        return self._num_entries
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def clear(self):
+        self._key_buffer[:] = bytes(len(self._key_buffer))
+        self._num_filled = 0
+        self.hits = 0
+        self.misses = 0
@@ -22,16 +22,54 @@ PAWN_ADVANTAGE = PIECE_VALUES[chess.PAWN]  # a lot of chess stats are measured i
 
 CHECKMATE_SCORE = 1000000
 
-
-def evaluate(position: chess.Board):
+# Pawn structure terms, in centipawns. Passed pawn bonus is indexed by rank, counted from the pawn's own side
+PASSED_PAWN_BONUS = (0, 5, 10, 20, 35, 60, 100, 0)
+DOUBLED_PAWN_PENALTY = 15  # per pawn on a file beyond the first
+ISOLATED_PAWN_PENALTY = 15
+BACKWARD_PAWN_PENALTY = 10
+PAWN_SHIELD_BONUS = 10  # per own pawn on the two ranks in front of a king still on its first two ranks
+
+
+def _build_pawn_masks():
+    # For each color and square: squares ahead on the same and adjacent files (passed pawn test), squares beside
+    # or behind on adjacent files (backward pawn test), and the two ranks in front on the king's files (shield)
+    passed, support, shield = ([0] * 64, [0] * 64), ([0] * 64, [0] * 64), ([0] * 64, [0] * 64)
+    for color in chess.COLORS:
+        for square in chess.SQUARES:
+            for other in chess.SQUARES:
+                file_distance = abs(chess.square_file(other) - chess.square_file(square))
+                ahead = chess.square_rank(other) - chess.square_rank(square)
+                ahead = ahead if color == chess.WHITE else -ahead
+                if file_distance <= 1 and ahead > 0:
+                    passed[color][square] |= chess.BB_SQUARES[other]
+                if file_distance == 1 and ahead <= 0:
+                    support[color][square] |= chess.BB_SQUARES[other]
+                if file_distance <= 1 and 0 < ahead <= 2:
+                    shield[color][square] |= chess.BB_SQUARES[other]
+    return passed, support, shield
+
+
+ADJACENT_FILE_MASKS = [(chess.BB_FILES[file - 1] if file > 0 else 0) | (chess.BB_FILES[file + 1] if file < 7 else 0)
+                       for file in range(8)]
+PASSED_PAWN_MASKS, PAWN_SUPPORT_MASKS, PAWN_SHIELD_MASKS = _build_pawn_masks()
+
+
+def evaluate(position: chess.Board, pawn_structure=False):
     # Does not check for fifty-move rule or threefold repetition or insufficient material
+    # pawn_structure adds pawn_structure_score and pawn_shield_score, see HashBoard for the cached version
     if position.is_checkmate():
         return CHECKMATE_SCORE if position.turn == chess.BLACK else -CHECKMATE_SCORE
     elif position.is_stalemate():
         return 0
+    return static_evaluate(position, pawn_structure)
+
 
+def static_evaluate(position: chess.Board, pawn_structure=False):
+    # evaluate without the checkmate and stalemate tests, for callers that know the game is not over
     score = material_score(position)
     score += piece_position_score(position)
+    if pawn_structure:
+        score += pawn_structure_score(position) + pawn_shield_score(position)
     return score/PAWN_ADVANTAGE
 
 
@@ -91,3 +129,49 @@ def piece_position_score(position: chess.Board):
     for square in position.pieces(chess.KING, chess.BLACK):
         score += PieceSquareTable.read(chess.KING, chess.BLACK, square)
     return score
+
+
+def pawn_structure_score(position: chess.Board):
+    """
+    Passed, doubled, isolated and backward pawns, in centipawns from white's perspective.
+    Depends only on where the pawns are, so it can be cached by a pawn key (see PawnHashTable)
+    """
+    score = 0
+    for color in chess.COLORS:
+        own_pawns = position.pawns & position.occupied_co[color]
+        enemy_pawns = position.pawns & position.occupied_co[not color]
+        color_score = 0
+        for file_mask, adjacent_mask in zip(chess.BB_FILES, ADJACENT_FILE_MASKS):
+            pawns_on_file = chess.popcount(own_pawns & file_mask)
+            if pawns_on_file:
+                color_score -= DOUBLED_PAWN_PENALTY * (pawns_on_file - 1)
+                if not own_pawns & adjacent_mask:
+                    color_score -= ISOLATED_PAWN_PENALTY * pawns_on_file
+        for square in chess.scan_forward(own_pawns):
+            rank = chess.square_rank(square) if color == chess.WHITE else 7 - chess.square_rank(square)
+            if not enemy_pawns & PASSED_PAWN_MASKS[color][square]:
+                color_score += PASSED_PAWN_BONUS[rank]
+            elif (own_pawns & ADJACENT_FILE_MASKS[chess.square_file(square)]
+                  and not own_pawns & PAWN_SUPPORT_MASKS[color][square]):
+                # no pawn beside or behind can support it, and its stop square is guarded by an enemy pawn
+                stop_square = square + 8 if color == chess.WHITE else square - 8
+                if chess.BB_PAWN_ATTACKS[color][stop_square] & enemy_pawns:
+                    color_score -= BACKWARD_PAWN_PENALTY
+        score += color_score if color == chess.WHITE else -color_score
+    return score
+
+
+def pawn_shield_score(position: chess.Board):
+    # Own pawns in front of each king still on its first two ranks, in centipawns from white's perspective.
+    # Kept out of pawn_structure_score because it depends on the kings too; a few bitboard operations anyway
+    score = 0
+    for color in chess.COLORS:
+        king_square = position.king(color)
+        if king_square is None:
+            continue
+        king_rank = chess.square_rank(king_square) if color == chess.WHITE else 7 - chess.square_rank(king_square)
+        if king_rank <= 1:
+            own_pawns = position.pawns & position.occupied_co[color]
+            shield = PAWN_SHIELD_BONUS * chess.popcount(own_pawns & PAWN_SHIELD_MASKS[color][king_square])
+            score += shield if color == chess.WHITE else -shield
+    return score
@@ -0,0 +1,145 @@
+"""
+NNUE-style evaluation: a small network whose first layer can be updated move by move
+Input features are the 768 piece-square pairs, in the layout of batch_eval's piece planes (plane * 64 + square).
+The first layer maps them to a hidden accumulator: the sum of the weight rows of the features present, plus a bias.
+A move only adds and removes a few features, so HashBoard keeps the accumulator up to date by adding and subtracting
+weight rows in make_move / undo_move (see update). The remaining layers are small and computed on demand:
+    clipped ReLU -> dense (hidden_size -> output_hidden_size) -> clipped ReLU -> dense (-> 1)
+Output is in pawns, from white's perspective, like eval_func.evaluate.
+Weights are loaded from .npz files with the arrays named in WEIGHT_NAMES. Without a weights file, load_evaluator
+returns None and callers keep using eval_func.
+"""
+
+
+import os
+import random
+
+import chess
+import numpy as np
+
+from agents.evaluation import batch_eval
+from agents.evaluation import eval_func
+
+
+NUM_FEATURES = batch_eval.NUM_PLANES * 64
+WEIGHT_NAMES = ("feature_weights", "feature_bias", "hidden_weights", "hidden_bias", "output_weights", "output_bias")
+
+
+def feature_index(piece_type: chess.PieceType, color: chess.Color, square: chess.Square) -> int:
+    return batch_eval.plane_index(piece_type, color) * 64 + square
+
+
+class NNUEEvaluator:
+    """
+    Attributes
+    feature_weights (NUM_FEATURES, hidden_size) and feature_bias (hidden_size,) : first layer
+    hidden_weights (hidden_size, output_hidden_size), hidden_bias, output_weights (output_hidden_size,),
+        output_bias (scalar) : remaining layers
+    All float64: adding and subtracting rows over a long search does not drift, and no conversions are needed
+    cache_key (int) : random 64-bit key, XORed into evaluation cache keys so networks don't share cached scores
+    """
+    HIDDEN_SIZE = 256
+    OUTPUT_HIDDEN_SIZE = 32
+
+    def __init__(self, feature_weights, feature_bias, hidden_weights, hidden_bias, output_weights, output_bias):
+        self.feature_weights = np.ascontiguousarray(feature_weights, dtype=np.float64)
+        self.feature_bias = np.asarray(feature_bias, dtype=np.float64)
+        self.hidden_weights = np.asarray(hidden_weights, dtype=np.float64)
+        self.hidden_bias = np.asarray(hidden_bias, dtype=np.float64)
+        self.output_weights = np.asarray(output_weights, dtype=np.float64)
+        self.output_bias = float(output_bias)
+        hidden_size = self.feature_bias.shape[0]
+        output_hidden_size = self.hidden_bias.shape[0]
+        if (self.feature_weights.shape != (NUM_FEATURES, hidden_size)
+                or self.hidden_weights.shape != (hidden_size, output_hidden_size)
+                or self.output_weights.shape != (output_hidden_size,)):
+            raise RuntimeError(f"NNUE weight shapes don't fit together: feature weights {self.feature_weights.shape}, "
+                               f"hidden weights {self.hidden_weights.shape}, output weights "
+                               f"{self.output_weights.shape}")
+        self.cache_key = random.getrandbits(64)
+
+    @classmethod
+    def load(cls, path) -> "NNUEEvaluator":
+        with np.load(path) as weights:
+            missing = [name for name in WEIGHT_NAMES if name not in weights]
+            if missing:
+                raise RuntimeError(f"NNUE weights file '{path}' is missing arrays {missing}!")
+            return cls(*(weights[name] for name in WEIGHT_NAMES))
+
+    @classmethod
+    def initialize(cls, hidden_size=HIDDEN_SIZE, output_hidden_size=OUTPUT_HIDDEN_SIZE, seed=None) -> "NNUEEvaluator":
+        # Untrained network with small random weights, a starting point for training (and for testing)
+        rng = np.random.default_rng(seed)
+        return cls(rng.normal(0, 0.05, (NUM_FEATURES, hidden_size)), np.full(hidden_size, 0.5),
+                   rng.normal(0, 1 / np.sqrt(hidden_size), (hidden_size, output_hidden_size)),
+                   np.zeros(output_hidden_size),
+                   rng.normal(0, 1 / np.sqrt(output_hidden_size), output_hidden_size), 0.0)
+
+    def save(self, path):
+        np.savez(path, **{name: getattr(self, name) for name in WEIGHT_NAMES})
+
+    """
+    Accumulator
+    """
+
+    def new_accumulator(self, board: chess.Board) -> np.ndarray:
+        # First layer output of board, from scratch
+        features = [feature_index(piece_type, color, square) for color in chess.COLORS
+                    for piece_type in chess.PIECE_TYPES
+                    for square in chess.scan_forward(board.pieces_mask(piece_type, color))]
+        return self.feature_bias + self.feature_weights[features].sum(axis=0)
+
+    def update(self, accumulator: np.ndarray, changes, direction: int):
+        """
+        Updates accumulator in place for piece changes given as (piece_type, color, square, sign) tuples, sign being
+        +1 for a piece added and -1 for a piece removed. direction is 1 when making the move and -1 when undoing it
+        """
+        for piece_type, color, square, sign in changes:
+            row = self.feature_weights[feature_index(piece_type, color, square)]
+            if direction * sign > 0:
+                np.add(accumulator, row, out=accumulator)
+            else:
+                np.subtract(accumulator, row, out=accumulator)
+
+    def forward(self, accumulator: np.ndarray) -> float:
+        # Remaining layers, from the accumulator to the score in pawns (white's perspective)
+        # minimum / maximum are a few times cheaper than np.clip on arrays this small
+        hidden = np.minimum(np.maximum(accumulator, 0.0), 1.0) @ self.hidden_weights
+        hidden += self.hidden_bias
+        np.minimum(np.maximum(hidden, 0.0, out=hidden), 1.0, out=hidden)
+        return float(hidden @ self.output_weights) + self.output_bias
+
+    """
+    Evaluation
+    """
+
+    def evaluate(self, position: chess.Board) -> float:
+        # Drop-in for eval_func.evaluate: checkmate and stalemate are scored the same, other positions by the network
+        if position.is_checkmate():
+            return eval_func.CHECKMATE_SCORE if position.turn == chess.BLACK else -eval_func.CHECKMATE_SCORE
+        elif position.is_stalemate():
+            return 0
+        return self.forward(self.new_accumulator(position))
+
+    def __call__(self, planes: np.ndarray) -> np.ndarray:
+        """
+        Batch evaluator (see batch_eval): scores a (K, 12, 64) piece plane tensor, all positions at once
+        """
+        accumulators = planes.reshape(len(planes), -1).astype(np.float64) @ self.feature_weights + self.feature_bias
+        hidden = np.clip(accumulators, 0.0, 1.0) @ self.hidden_weights + self.hidden_bias
+        return np.clip(hidden, 0.0, 1.0) @ self.output_weights + self.output_bias
+
+
+def load_evaluator(path) -> NNUEEvaluator | None:
+    # Network stored at path, or None (fall back to eval_func) if there is no such file
+    if path is None or not os.path.exists(path):
+        print(f"*** No NNUE weights at '{path}', using eval_func instead ***")
+        return None
+    return NNUEEvaluator.load(path)
+
+
+def evaluate(position: chess.Board, evaluator: NNUEEvaluator | None = None) -> float:
+    # Scores position with evaluator, or with eval_func.evaluate if there is none
+    if evaluator is None:
+        return eval_func.evaluate(position)
+    return evaluator.evaluate(position)
@@ -0,0 +1,37 @@
+"""
+Pawn hash table
+Caches eval_func.pawn_structure_score by pawn key (the Zobrist hash of the pawns, kept by HashBoard).
+Pawns move far less often than the other pieces, so most positions of a search share their pawn key with
+one evaluated before. The table is kept between moves (one per hasher), so a game's searches start from the
+structures of the ones before: over the searches of a game hit rates are about 93-95%, and above 90% from every
+test position (see test_files/pawn_hash_benchmark.py). Lookups only happen on evaluation cache misses, i.e. for
+positions new to the search, so the first search of a game, from an empty table, is lower (about 82-94%).
+"""
+
+
+import weakref
+
+import chess
+
+from agents.evaluation import eval_func
+from agents.evaluation.eval_cache import EvalCache
+
+
+class PawnHashTable(EvalCache):
+    DEFAULT_SIZE_MB = 2  # 131072 entries; long searches see more distinct structures than 0.25 MB holds
+
+    _hasher_caches = weakref.WeakKeyDictionary()  # ZobristHash -> PawnHashTable, kept apart from evaluation caches
+
+    def __init__(self, size_mb=DEFAULT_SIZE_MB):
+        """
+        size_mb (float) : memory budget of the table
+        """
+        super().__init__(size_mb)
+
+    def score(self, pawn_key: int, position: chess.Board) -> float:
+        # Pawn structure score of position (centipawns, white's perspective), computed on a miss
+        score = self.get(pawn_key)
+        if score is None:
+            score = eval_func.pawn_structure_score(position)
+            self.add(pawn_key, score)
+        return score
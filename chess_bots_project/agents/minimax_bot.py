@@ -5,69 +5,434 @@ from playground.read_only_board import ReadOnlyBoard
 from playground.hash_board import HashBoard
 from agents import Agent
 from agents.evaluation import eval_func
+from agents.evaluation.eval_cache import EvalCache
+from agents.evaluation.pawn_hash_table import PawnHashTable
 from agents.search.zobrist_hash import ZobristHash
-from agents.search.transposition_table import TranspositionTable
+from agents.search.transposition_table import TranspositionTable, NodeType
 from agents.evaluation.piece_square_table import PieceSquareTable
 from agents.search import move_order
+from agents.search.search_heuristics import SearchHeuristics
 import math
+import multiprocessing
+import time
+import weakref
 from timeit import default_timer  # For runtime profiling
 
 
+class SearchAborted(Exception):
+    """
+    Raised inside the search when the time or node budget runs out.
+    Unwinds the current iteration of iterative deepening; its partial result is discarded.
+    """
+    pass
+
+
 class MinimaxBot(Agent):
     """
     Functions
     minimax(chess.Board, alpha: float, beta: float, depth: int) -> float
     get_o
+
+    Search budget (can be set per bot in the constructor, or per call in get_move)
+    time_limit (float)  : seconds allowed per move. None means no time limit
+    node_limit (int)    : number of nodes allowed per move. None means no node limit
+    max_depth (int)     : deepest iteration of iterative deepening to search
+    tt_size_mb (float)  : memory budget of the transposition table, which is kept across moves
+    use_quiescence (bool) : search captures and promotions past the horizon instead of evaluating right away
+    heuristics (SearchHeuristics) : killer / history / counter move tables. Pass one in to share it between bots
+    use_pvs (bool)      : principal variation search. Moves after the first are searched with a null window,
+                          and only re-searched with the full window if they turn out better
+    aspiration_window (float) : half-width (in pawns) of the root window around the previous iteration's score.
+                                None searches every iteration with an infinite window
+    Selective search (each can be turned off to measure its effect)
+    use_null_move (bool) : null move pruning. Let opponent move twice in a row; if we're still above beta, prune
+    use_lmr (bool)       : late move reductions. Quiet moves late in the move order are searched shallower first
+    use_futility (bool)  : futility and reverse futility pruning near the leaves, based on the static evaluation
+    use_pawn_structure (bool) : add pawn structure terms (passed, doubled, isolated, backward pawns, pawn shields)
+                                to the evaluation, cached in the PawnHashTable of the hasher
+    use_activity (bool)  : add mobility and king safety terms to the evaluation (see agents.evaluation.bitboard_eval)
+    nnue (NNUEEvaluator) : evaluate with this network instead of eval_func (see agents.evaluation.nnue_eval).
+                           nnue_eval.load_evaluator gives None, i.e. eval_func, when there is no weights file
+    Parallel search
+    num_workers (int)    : number of processes for lazy SMP search. With more than one, the transposition table
+                           is kept in shared memory, and every worker searches the root with a slightly different
+                           depth schedule and move order, sharing results through the table
+    hasher (ZobristHash), transposition_table (TranspositionTable) : pass in to share them with other bots
     """
-    def __init__(self, name="conventional_bot"):
+    DEFAULT_MAX_DEPTH = 5
+    MAX_PLY = 128  # size of the principal variation table
+    TIME_CHECK_INTERVAL = 1024  # number of nodes between two checks of the clock
+    DELTA_MARGIN = 200  # centipawns. Quiescence skips captures that can't raise alpha even with this much to spare
+    NULL_WINDOW = 0.01  # width of PVS null window, in pawns (1 centipawn)
+    DEFAULT_ASPIRATION_WINDOW = 0.5
+    MAX_ASPIRATION_WINDOW = 8  # after widening past this many pawns, give up and use an infinite window
+    NULL_MOVE_MIN_DEPTH = 3
+    LMR_MIN_DEPTH = 3
+    LMR_FULL_DEPTH_MOVES = 3  # number of moves searched at full depth before reductions start
+    LMR_LATE_MOVES = 8  # moves after this many are reduced by one more ply
+    LMR_HISTORY_THRESHOLD = 100  # quiet moves with at least this history score are reduced by one ply less
+    FUTILITY_MARGINS = (0, 2.0, 3.5)  # in pawns, indexed by depth left
+    REVERSE_FUTILITY_MARGIN = 1.2  # in pawns, per ply of depth left
+
+    def __init__(self, name="conventional_bot", time_limit=None, node_limit=None, max_depth=DEFAULT_MAX_DEPTH,
+                 tt_size_mb=TranspositionTable.DEFAULT_SIZE_MB, use_quiescence=True, heuristics=None,
+                 use_pvs=True, aspiration_window=DEFAULT_ASPIRATION_WINDOW,
+                 use_null_move=True, use_lmr=True, use_futility=True, use_pawn_structure=False, use_activity=False,
+                 nnue=None, num_workers=1, hasher=None, transposition_table=None):
         super().__init__(name)
         self._num_pos_searched = 0
-        self._zobrist_hasher = ZobristHash()
-        self._transposition_table = TranspositionTable(self._zobrist_hasher)
+        self._zobrist_hasher = hasher if hasher is not None else ZobristHash()
+        self._num_workers = max(1, num_workers)
+        self._tt_size_mb = tt_size_mb
+        if transposition_table is not None:
+            self._transposition_table = transposition_table
+        elif self._num_workers > 1:
+            self._transposition_table = TranspositionTable.create_shared(self._zobrist_hasher, size_mb=tt_size_mb)
+        else:
+            self._transposition_table = TranspositionTable(self._zobrist_hasher, size_mb=tt_size_mb)
+        self._worker_pool = None  # lazy SMP processes, started by the first search and kept until close()
+        self._pool_finalizer = None
         self._cur_transposition_cnt = 0
+        self._tt_hits = 0
+        self._eval_cache_counts = (0, 0)  # evaluation cache hits and misses when the search started
+        self._pawn_table = PawnHashTable.for_hasher(self._zobrist_hasher) if use_pawn_structure else None
+        self._pawn_table_counts = (0, 0)
+        self._use_activity = use_activity
+        self._nnue = nnue
         self._opp_pawn_attacks = None
+        # Search budget
+        self._time_limit = time_limit
+        self._node_limit = node_limit
+        self._max_depth = max_depth
+        self._deadline = None
+        self._cur_node_limit = None
+        self._budget_active = False
+        self._num_nodes = 0
+        self._num_qnodes = 0
+        self._use_quiescence = use_quiescence
+        self._heuristics = heuristics if heuristics is not None else SearchHeuristics(self.MAX_PLY)
+        self._use_pvs = use_pvs
+        self._aspiration_window = aspiration_window
+        self._num_pvs_researches = 0
+        self._num_aspiration_researches = 0
+        self._iteration_stats = []
+        self._use_null_move = use_null_move
+        self._use_lmr = use_lmr
+        self._use_futility = use_futility
+        self._selective_stats = self._new_selective_stats()
+        self._seldepth = 0
+        # Principal variation: triangular table filled during search, and the previous iteration's PV
+        # stored as {position hash: pv move} so it can be tried first in the next iteration
+        self._pv_table = [[] for _ in range(self.MAX_PLY + 1)]
+        self._pv_moves = dict()
+        self._pv_line = []
+        self._search_stats = dict()
+        # Settings handed to lazy SMP workers, which build their own bot around the shared table
+        self._worker_config = dict(use_quiescence=use_quiescence, use_pvs=use_pvs, aspiration_window=aspiration_window,
+                                   use_null_move=use_null_move, use_lmr=use_lmr, use_futility=use_futility,
+                                   use_pawn_structure=use_pawn_structure, use_activity=use_activity, nnue=nnue)
+
+    def get_move(self, read_only_board: ReadOnlyBoard, time_limit=None, node_limit=None, max_depth=None):
+        """
+        Iterative deepening driver. Searches depth 1, 2, 3... until max_depth is reached or the
+        time / node budget runs out, then returns the best move of the last finished iteration.
+        Budget arguments override the bot's defaults for this call only.
+        """
+        time_limit = self._time_limit if time_limit is None else time_limit
+        node_limit = self._node_limit if node_limit is None else node_limit
+        max_depth = self._max_depth if max_depth is None else max_depth
 
-    def get_move(self, read_only_board: ReadOnlyBoard):
-        self._num_pos_searched = 0
-        self._cur_transposition_cnt = 0
         # Get start time
         start_time = default_timer()
         position = read_only_board.get_copy()
-        best_move, best_eval = self._search_for_moves(position, 5)
+        # Table is kept from earlier moves, so search starts warm. Entries from older searches age out
+        self._transposition_table.new_search()
+
+        if self._num_workers > 1:
+            best_move, best_eval, stats = self._lazy_smp_search(position, start_time, time_limit, node_limit,
+                                                                max_depth)
+        else:
+            deadline = None if time_limit is None else start_time + time_limit
+            best_move, best_eval = self._iterative_deepening(position, deadline, node_limit, max_depth)
+            stats = self._collect_search_stats()
+
+        duration = default_timer() - start_time
+        stats["time"] = duration
+        stats["nps"] = (stats["nodes"] + stats["qnodes"]) / duration if duration > 0 else 0.0
+        self._search_stats = stats
         # Print num pos searched
-        print(f"***\n'{self.get_name()}' searched through {self._num_pos_searched} positions. Best eval: {best_eval}.")
-        print(f"Encountered {self._cur_transposition_cnt} new transpositions. {self._transposition_table.size()} entries total.")
+        print(f"***\n'{self.get_name()}' searched through {stats['leaf_positions']} positions. Best eval: {best_eval}.")
+        print(f"Completed depth {stats['depth']}, {stats['nodes']} nodes, {stats['qnodes']} qnodes "
+              f"(PVS {'on' if self._use_pvs else 'off'}: {stats['pvs_researches']} re-searches, "
+              f"{stats['aspiration_researches']} aspiration re-searches). PV: {' '.join(stats['pv'])}")
+        if self._num_workers > 1:
+            print(f"Lazy SMP: {self._num_workers} workers reached depths {stats['worker_depths']}.")
+        print(f"Stored {stats['tt_stores']} transpositions, {stats['tt_hits']} table hits. "
+              f"{self._transposition_table.size()} / {self._transposition_table.capacity()} entries filled.")
+        print(f"Eval cache: {stats['eval_cache_hits']} hits, {stats['eval_cache_misses']} misses.")
+        if self._pawn_table is not None:
+            print(f"Pawn table: {stats['pawn_table_hits']} hits, {stats['pawn_table_misses']} misses.")
         print("***")
         # Print time taken
-        duration = default_timer() - start_time
         print(f"### SYS INFO: time taken for move generation: {duration} ###")
-        # For now, we discard the transposition table every time we calculate a move
-        self._transposition_table.clear()
         return best_move
 
-    def _search_for_moves(self, board: chess.Board, search_depth=5) -> (chess.Move, float):
+    def _iterative_deepening(self, position: chess.Board, deadline, node_limit, max_depth, first_depth=1):
+        """
+        Searches position to depth first_depth, first_depth + 1, ... max_depth, until the deadline (timer value)
+        or node limit is hit. Returns best move and eval (white's perspective) of the last finished iteration
+        """
+        self._num_pos_searched = 0
+        self._cur_transposition_cnt = 0
+        self._tt_hits = 0
+        self._num_nodes = 0
+        self._num_qnodes = 0
+        self._num_pvs_researches = 0
+        self._num_aspiration_researches = 0
+        self._iteration_stats = []
+        self._selective_stats = self._new_selective_stats()
+        self._seldepth = 0
+        self._pv_moves = dict()
+        self._pv_line = []
+        self._deadline = deadline
+        self._cur_node_limit = node_limit
+        self._heuristics.new_search(position.ply())
+        eval_cache = EvalCache.for_hasher(self._zobrist_hasher)
+        self._eval_cache_counts = (eval_cache.hits, eval_cache.misses)
+        if self._pawn_table is not None:
+            self._pawn_table_counts = (self._pawn_table.hits, self._pawn_table.misses)
+        start_time = default_timer()
+
+        best_move, best_eval = chess.Move.null(), 0.0
+        root_score = None  # score of last iteration, from the bot's perspective
+        self._completed_depth = 0
+        first_depth = min(first_depth, max(max_depth, 1))
+        for depth in range(first_depth, max(max_depth, 1) + 1):
+            # First iteration is always finished so that we have a move to return
+            self._budget_active = depth > first_depth
+            if depth > first_depth:
+                self._heuristics.new_iteration()
+            try:
+                move, evaluation = self._search_for_moves(position, depth, root_score)
+            except SearchAborted:
+                break
+            best_move, best_eval = move, evaluation
+            root_score = evaluation if position.turn == chess.WHITE else -evaluation
+            self._completed_depth = depth
+            self._iteration_stats.append({"depth": depth, "seldepth": self._seldepth, "nodes": self._num_nodes,
+                                          "qnodes": self._num_qnodes, "time": default_timer() - start_time})
+            self._store_pv(position, self._pv_table[0], depth)
+            if self._budget_exhausted():
+                break
+        self._budget_active = False
+        return best_move, best_eval
+
+    @staticmethod
+    def _new_selective_stats() -> dict:
+        return {"null_move_cutoffs": 0, "lmr_reductions": 0, "lmr_researches": 0,
+                "futility_prunes": 0, "reverse_futility_prunes": 0}
+
+    def _collect_search_stats(self) -> dict:
+        # Statistics of the last _iteration_deepening call. Time and nps are added by get_move
+        eval_cache = EvalCache.for_hasher(self._zobrist_hasher)
+        pawn_table_counts = (0, 0) if self._pawn_table is None else (self._pawn_table.hits, self._pawn_table.misses)
+        return {
+            "depth": self._completed_depth,
+            "seldepth": self._seldepth,
+            "nodes": self._num_nodes,
+            "qnodes": self._num_qnodes,
+            "leaf_positions": self._num_pos_searched,
+            "tt_hits": self._tt_hits,
+            "tt_stores": self._cur_transposition_cnt,
+            "eval_cache_hits": eval_cache.hits - self._eval_cache_counts[0],
+            "eval_cache_misses": eval_cache.misses - self._eval_cache_counts[1],
+            "pawn_table_hits": pawn_table_counts[0] - self._pawn_table_counts[0],
+            "pawn_table_misses": pawn_table_counts[1] - self._pawn_table_counts[1],
+            "pvs": self._use_pvs,
+            "pvs_researches": self._num_pvs_researches,
+            "aspiration_researches": self._num_aspiration_researches,
+            "iterations": self._iteration_stats,
+            **self._selective_stats,
+            "pv": [move.uci() for move in self._pv_line],
+        }
+
+    def _lazy_smp_search(self, position: chess.Board, start_time, time_limit, node_limit, max_depth):
+        """
+        Runs _iterative_deepening in num_workers processes sharing the transposition table.
+        Odd workers start one ply deeper, and every helper has its own history noise, so they don't all search
+        the same moves in the same order. Returns the result of the worker that completed the deepest
+        iteration (the lowest worker id on ties) and statistics with node counts summed over all workers.
+        Every worker starts from our killer / history / counter move tables, and we keep worker 0's tables
+        (the one without history noise) afterwards, so they carry over between moves as in a single process search.
+        The worker processes are kept between moves. time_limit counts from start_time (when get_move was called):
+        workers get it as a wall clock deadline, so starting them on the first move comes out of that move's budget.
+        """
+        pool = self._get_worker_pool()
+        deadline = None if time_limit is None else time.time() + time_limit - (default_timer() - start_time)
+        worker_node_limit = None if node_limit is None else max(1, node_limit // self._num_workers)
+        args = [(worker_id, position, self._zobrist_hasher, self._transposition_table.shared_memory_name(),
+                 self._tt_size_mb, self._transposition_table.get_age(), self._worker_config, self._heuristics,
+                 deadline, worker_node_limit, max_depth)
+                for worker_id in range(self._num_workers)]
+        results = pool.map(_lazy_smp_worker, args)
+
+        best_result = max(results, key=lambda result: (result[2]["depth"], -result[0]))
+        stats = dict(best_result[2])
+        for key in ("nodes", "qnodes", "leaf_positions", "tt_hits", "tt_stores", "eval_cache_hits", "eval_cache_misses",
+                    "pawn_table_hits", "pawn_table_misses", "pvs_researches",
+                    "aspiration_researches", *self._selective_stats):
+            stats[key] = sum(result[2][key] for result in results)
+        stats["seldepth"] = max(result[2]["seldepth"] for result in results)
+        stats["worker_depths"] = [result[2]["depth"] for result in results]
+        stats["workers"] = self._num_workers
+        self._heuristics.copy_from(results[0][4])
+        # our own counters, as if this process had searched
+        self._num_nodes, self._num_qnodes = stats["nodes"], stats["qnodes"]
+        self._num_pos_searched = stats["leaf_positions"]
+        self._tt_hits, self._cur_transposition_cnt = stats["tt_hits"], stats["tt_stores"]
+        self._completed_depth, self._seldepth = stats["depth"], stats["seldepth"]
+        self._pv_line = [chess.Move.from_uci(move) for move in stats["pv"]]
+        return chess.Move.from_uci(best_result[1]), best_result[3], stats
+
+    def _get_worker_pool(self) -> multiprocessing.Pool:
+        # Lazy SMP worker processes, started on first use. Terminated if the bot is collected without close()
+        if self._worker_pool is None:
+            self._worker_pool = multiprocessing.Pool(processes=self._num_workers)
+            self._pool_finalizer = weakref.finalize(self, self._worker_pool.terminate)
+        return self._worker_pool
+
+    def close(self):
+        # Stops the lazy SMP worker processes and releases the shared memory transposition table, if any
+        if self._worker_pool is not None:
+            self._pool_finalizer.detach()
+            self._worker_pool.close()
+            self._worker_pool.join()
+            self._worker_pool = None
+        self._transposition_table.close()
+
+    def evaluate_position(self, hash_board: HashBoard, depth=0, node_limit=None) -> float | None:
+        """
+        Score of hash_board's position (pawns, white's perspective) from a fixed depth search with a full window.
+        Depth 0 runs a quiescence search only (or returns the static evaluation if use_quiescence is off).
+        Returns None if the search needs more than node_limit nodes; hash_board is back in its position either way.
+        For other search drivers, e.g. MCTS leaf evaluation. Results are stored in the transposition table as exact
+        scores, so it doubles as a cache of evaluations; the table and move ordering tables are kept between calls
+        """
+        self._deadline = None
+        self._cur_node_limit = None if node_limit is None else self._num_nodes + self._num_qnodes + node_limit
+        self._budget_active = node_limit is not None
+        pos_hash_key = hash_board.get_position_hash()
+        num_moves = len(hash_board.get_shallow_copy().move_stack)
+        try:
+            score = self._negamax(hash_board, depth=depth, alpha=-math.inf, beta=math.inf, ply=0)
+        except SearchAborted:
+            # unwind the moves the search was in the middle of
+            while len(hash_board.get_shallow_copy().move_stack) > num_moves:
+                hash_board.undo_move()
+            return None
+        finally:
+            self._budget_active = False
+        if depth <= 0:
+            # _negamax only stores positions with depth left
+            self._transposition_table.add(pos_hash_key, score, 0, NodeType.PV)
+        return score if hash_board.turn() else -score
+
+    def num_nodes_searched(self) -> int:
+        # nodes (including quiescence nodes) searched since the last get_move, or since the bot was made
+        return self._num_nodes + self._num_qnodes
+
+    def get_search_heuristics(self) -> SearchHeuristics:
+        """
+        Returns the killer / history / counter move tables, so other search drivers can reuse them
+        """
+        return self._heuristics
+
+    def get_search_stats(self) -> dict:
+        """
+        Returns statistics of the last search (completed depth, nodes, leaf positions, time, nps, pv,
+        re-search counts, and cumulative nodes after each iteration)
+        """
+        return self._search_stats
+
+    def _search_for_moves(self, board: chess.Board, search_depth=5, prev_score=None) -> (chess.Move, float):
+        """
+        Searches the root position. With an aspiration window, the search starts with a narrow window around
+        prev_score (previous iteration's score, from the side to move's perspective), and is repeated with a
+        wider window whenever the result falls outside it.
+        """
         if search_depth <= 0:
             search_depth = 1  # force set depth to at least one so we can
 
-        hash_board = HashBoard(board, self._zobrist_hasher)
+        hash_board = HashBoard(board, self._zobrist_hasher, pawn_table=self._pawn_table, nnue=self._nnue,
+                               use_activity=self._use_activity)
+        bot_color = hash_board.turn()
+        window = self._aspiration_window
+        if window is None or prev_score is None or search_depth <= 1 or abs(prev_score) == math.inf:
+            alpha, beta = -math.inf, math.inf
+        else:
+            alpha, beta = prev_score - window, prev_score + window
+
+        while True:
+            best_move, score = self._search_root(hash_board, search_depth, alpha, beta)
+            if score <= alpha and alpha != -math.inf:
+                # fail low: true score is somewhere below the window
+                window *= 2
+                alpha = prev_score - window if window <= self.MAX_ASPIRATION_WINDOW else -math.inf
+            elif score >= beta and beta != math.inf:
+                # fail high: true score is somewhere above the window
+                window *= 2
+                beta = prev_score + window if window <= self.MAX_ASPIRATION_WINDOW else math.inf
+            else:
+                break
+            self._num_aspiration_researches += 1
+
+        best_eval = score if bot_color else -score
+        return (best_move, best_eval)
+
+    def _search_root(self, hash_board: HashBoard, search_depth: int, alpha: float, beta: float) -> (chess.Move, float):
+        # Same as _negamax, but at the root, where we need the best move and not just the score
         bot_color = hash_board.turn()
+        alpha_orig = alpha
         best_move = chess.Move.null()
-        # Initialize alpha and beta for the mini / nega max search
-        alpha = -math.inf
-        move_lst = self._get_ordered_move_lst(hash_board.get_shallow_copy())
-        # move_lst = board.legal_moves
+        self._pv_table[0] = []
+        root_key = hash_board.get_position_hash()
+        pv_move = self._pv_moves.get(root_key)
+        history_key = self._heuristics.history_sort_key(bot_color)
+        move_lst = move_order.staged_move_generator(hash_board.get_shallow_copy(), pv_move,
+                                                    self._heuristics.get_killers(0), history_key)
         for move in move_lst:
             hash_board.make_move(move)
             # remember to negate result of negamax as good pos for opp is bad for us.
-            # Note: beta=-inf always at the lowest depth
-            evaluation = -self._negamax(hash_board, depth=search_depth-1, alpha=-math.inf, beta=-alpha)
+            evaluation = self._search_child(hash_board, search_depth - 1, alpha, beta, 1,
+                                            best_move == chess.Move.null())
             hash_board.undo_move()
-            if evaluation > alpha:
-                alpha = evaluation
+            if evaluation >= beta:
+                # fail high (only possible with an aspiration window)
+                self._transposition_table.add(root_key, beta, search_depth, NodeType.CUT, move)
+                self._pv_table[0] = [move]
+                return move, beta
+            if evaluation > alpha or best_move == chess.Move.null():
+                alpha = max(alpha, evaluation)
                 best_move = move
+                self._pv_table[0] = [move] + self._pv_table[1]
 
-        best_eval = alpha if bot_color else -alpha
-        return (best_move, best_eval)
+        node_type = NodeType.PV if alpha > alpha_orig else NodeType.ALL
+        self._transposition_table.add(root_key, alpha, search_depth, node_type, best_move)
+        return best_move, alpha
+
+    def _search_child(self, hash_board: HashBoard, depth: int, alpha: float, beta: float, ply: int, first: bool):
+        """
+        Searches the position after a move (already made on hash_board) and returns the score from the
+        mover's perspective. With PVS, every move but the first is first searched with a null window,
+        which only tells us whether it beats alpha. If it does, it is re-searched with the full window.
+        """
+        if first or not self._use_pvs:
+            return -self._negamax(hash_board, depth=depth, alpha=-beta, beta=-alpha, ply=ply)
+        evaluation = -self._negamax(hash_board, depth=depth, alpha=-alpha - self.NULL_WINDOW, beta=-alpha, ply=ply)
+        if alpha < evaluation < beta:
+            self._num_pvs_researches += 1
+            evaluation = -self._negamax(hash_board, depth=depth, alpha=-beta, beta=-alpha, ply=ply)
+        return evaluation
 
     # Note: depth refers to number of plies (half-moves) to search.
     # By convention, black tries to minimize score; white, maximize
@@ -119,7 +484,7 @@ class MinimaxBot(Agent):
         return best_evaluation
 
     # negamax version of minimax algorithm
-    def _negamax(self, hash_board: HashBoard, depth=5, alpha=-math.inf, beta=math.inf):
+    def _negamax(self, hash_board: HashBoard, depth=5, alpha=-math.inf, beta=math.inf, ply=0):
         """
         Negamax version of minimax algorithm
         Evaluation is now defined to be positive if it is good for current player,
@@ -129,46 +494,252 @@ class MinimaxBot(Agent):
         depth (int)         : positive int representing depth (num ply) left to search
         alpha (float)       : (positive) score of best eval for current player seen so far
         beta (float)        : (negative) score of worst eval for current player seen so far
+        ply (int)           : distance (num ply) from the root of the search
         """
+        self._num_nodes += 1
+        if self._budget_active:
+            self._check_budget()
+        self._pv_table[ply] = []
+        self._seldepth = max(self._seldepth, ply)
+        if ply > 0 and hash_board.is_draw():
+            # repetition, fifty-move rule or insufficient material, from hash comparisons and counters
+            self._num_pos_searched += 1
+            return 0.0
 
         pos_hash_key = hash_board.get_position_hash()
-        if self._transposition_table.get(pos_hash_key) is not None:
-            # if we already computed the position in our transposition table, just return
-            return self._transposition_table.table[pos_hash_key].score
+        tt_entry = self._transposition_table.get(pos_hash_key)
+        tt_move = None
+        if tt_entry is not None:
+            tt_move = tt_entry.best_move
+            # Score can only be reused if it was searched at least as deep, and its bound applies to our window
+            if tt_entry.depth >= depth:
+                if tt_entry.node_type == NodeType.PV:
+                    self._tt_hits += 1
+                    return min(max(tt_entry.score, alpha), beta)
+                elif tt_entry.node_type == NodeType.CUT and tt_entry.score >= beta:
+                    self._tt_hits += 1
+                    return beta
+                elif tt_entry.node_type == NodeType.ALL and tt_entry.score <= alpha:
+                    self._tt_hits += 1
+                    return alpha
 
-        if depth <= 0 or hash_board.outcome() is not None:
-            # we hit maximum depth -> return evaluation
-            perspective = 1 if hash_board.turn() else -1
+        if depth <= 0 or ply >= self.MAX_PLY:
+            if depth <= 0 and self._use_quiescence:
+                # resolve captures before trusting the static evaluation
+                return self._quiescence(hash_board, alpha, beta)
+            # we hit maximum depth -> return evaluation, checkmate and stalemate included
             self._num_pos_searched += 1
-            evaluation = perspective * eval_func.evaluate(hash_board.get_shallow_copy())
-            return evaluation
+            return self._leaf_eval(hash_board, check_terminal=True)
+
+        board = hash_board.get_shallow_copy()
+        in_check = hash_board.is_check()
+
+        color = board.turn
+        prev_move = board.peek() if board.move_stack else None
+        static_eval = None
+        if not in_check and (self._use_null_move or self._use_futility):
+            # the same evaluation the leaves return (pawn structure or NNUE included), so margins compare like with
+            # like. Read from the evaluation cache when the position was evaluated before
+            static_eval = self._leaf_eval(hash_board, check_terminal=False)
+        # Pruning is unsafe when bounds are mate scores, as the static evaluation is meaningless there, and at PV
+        # nodes, where a cutoff on the static evaluation alone could cut the principal variation. Only null window
+        # nodes are pruned (with slack, as -alpha - NULL_WINDOW rounds)
+        prune_allowed = (static_eval is not None and abs(beta) < eval_func.CHECKMATE_SCORE / 2
+                         and beta - alpha < 2 * self.NULL_WINDOW)
+
+        # Reverse futility pruning: close to the leaves, static eval so far above beta that no move will fall below it
+        if (self._use_futility and prune_allowed and depth < len(self.FUTILITY_MARGINS)
+                and static_eval - self.REVERSE_FUTILITY_MARGIN * depth >= beta):
+            self._selective_stats["reverse_futility_prunes"] += 1
+            return beta
+
+        # Null move pruning: if we still beat beta after passing the turn, a real move almost surely does too.
+        # Zugzwang guards: not in check, no two null moves in a row, and we must have pieces besides pawns
+        if (self._use_null_move and prune_allowed and depth >= self.NULL_MOVE_MIN_DEPTH and static_eval >= beta
+                and prev_move and board.occupied_co[color] & ~(board.pawns | board.kings)):
+            reduction = 3 if depth >= 6 else 2
+            hash_board.make_move(chess.Move.null())
+            evaluation = -self._negamax(hash_board, depth=depth - 1 - reduction, alpha=-beta,
+                                        beta=-beta + self.NULL_WINDOW, ply=ply + 1)
+            hash_board.undo_move()
+            if evaluation >= beta:
+                self._selective_stats["null_move_cutoffs"] += 1
+                return beta
+
+        # Futility pruning: at the last plies, quiet moves can't raise a static eval this far below alpha
+        futile = (self._use_futility and static_eval is not None and depth < len(self.FUTILITY_MARGINS)
+                  and abs(alpha) < eval_func.CHECKMATE_SCORE / 2
+                  and static_eval + self.FUTILITY_MARGINS[depth] <= alpha)
 
         # I tested and found that move ordering makes things faster
-        move_lst = self._get_ordered_move_lst(hash_board.get_shallow_copy())
-        # move_lst = board.legal_moves
+        # Best move stored in the table is tried first, then the previous iteration's pv move.
+        # Moves are generated lazily in stages, so a cutoff by an early move saves generating the rest
+        pv_move = tt_move if tt_move is not None else self._pv_moves.get(pos_hash_key)
+        history_key = self._heuristics.history_sort_key(color)
+        move_lst = move_order.staged_move_generator(board, pv_move, self._heuristics.get_killers(ply, prev_move),
+                                                    history_key)
+        best_move = None
+        move_index = 0
+        has_legal_move = False
         for move in move_lst:
+            has_legal_move = True
+            is_quiet = move.promotion is None and not board.is_capture(move)
             # Evaluate move. Make move, evaluate, then unmake
             hash_board.make_move(move)
-            # we need to negate as what's good for opponent is bad for current player
-            evaluation = -self._negamax(hash_board, depth=depth - 1, alpha=-beta, beta=-alpha)
+            gives_check = board.is_check()
+            if futile and move_index > 0 and is_quiet and not gives_check:
+                hash_board.undo_move()
+                self._selective_stats["futility_prunes"] += 1
+                continue
+
+            evaluation = None
+            if (self._use_lmr and move_index >= self.LMR_FULL_DEPTH_MOVES and depth >= self.LMR_MIN_DEPTH
+                    and is_quiet and not in_check and not gives_check):
+                # Late move reduction: search with a null window at reduced depth; if it beats alpha,
+                # fall through to the normal full depth search
+                reduction = 2 if move_index >= self.LMR_LATE_MOVES else 1
+                if history_key(move) >= self.LMR_HISTORY_THRESHOLD:
+                    reduction -= 1
+                if reduction > 0:
+                    self._selective_stats["lmr_reductions"] += 1
+                    evaluation = -self._negamax(hash_board, depth=depth - 1 - reduction, alpha=-alpha - self.NULL_WINDOW,
+                                                beta=-alpha, ply=ply + 1)
+                    if evaluation > alpha:
+                        self._selective_stats["lmr_researches"] += 1
+                        evaluation = None
+            if evaluation is None:
+                # we need to negate as what's good for opponent is bad for current player
+                evaluation = self._search_child(hash_board, depth - 1, alpha, beta, ply + 1, move_index == 0)
             hash_board.undo_move()
+            move_index += 1
             # Check for best evaluation
             if evaluation >= beta:
-                # Move was too good! Opp will avoid this
-                self._transposition_table.add(pos_hash_key, beta, hash_board.ply())
+                # Move was too good! Opp will avoid this. Score is a lower bound
+                if is_quiet:
+                    self._heuristics.update_cutoff(color, move, ply, depth, prev_move)
+                self._transposition_table.add(pos_hash_key, beta, depth, NodeType.CUT, move)
                 self._cur_transposition_cnt += 1
                 return beta
-            alpha = max(alpha, evaluation)
+            if evaluation > alpha:
+                alpha = evaluation
+                best_move = move
+                self._pv_table[ply] = [move] + self._pv_table[ply + 1]
+
+        if not has_legal_move:
+            # the game is over: checkmate or stalemate
+            self._num_pos_searched += 1
+            return -eval_func.CHECKMATE_SCORE if in_check else 0.0
 
-        # Add position to transposition table before returning. Assumes we already checked position is not in table
-        self._transposition_table.add(pos_hash_key, alpha, hash_board.ply())
+        # Add position to transposition table before returning.
+        # If no move raised alpha, we only know an upper bound of the score
+        node_type = NodeType.PV if best_move is not None else NodeType.ALL
+        self._transposition_table.add(pos_hash_key, alpha, depth, node_type, best_move)
         self._cur_transposition_cnt += 1
         return alpha
 
+    def _quiescence(self, hash_board: HashBoard, alpha: float, beta: float):
+        """
+        Searches only captures and promotions, so positions are not evaluated in the middle of an exchange.
+        Same score convention as _negamax. The side to move may "stand pat" (decline to capture) and keep
+        the static evaluation, so the static evaluation is a lower bound of the score.
+        In check, there is no standing pat: every evasion is searched, quiet ones included, without delta pruning
+        """
+        self._num_qnodes += 1
+        if self._budget_active:
+            self._check_budget()
+
+        self._num_pos_searched += 1
+        board = hash_board.get_shallow_copy()
+        if hash_board.is_check():
+            has_legal_move = False
+            for move in move_order.staged_move_generator(board):
+                has_legal_move = True
+                hash_board.make_move(move)
+                evaluation = -self._quiescence(hash_board, alpha=-beta, beta=-alpha)
+                hash_board.undo_move()
+                if evaluation >= beta:
+                    return beta
+                alpha = max(alpha, evaluation)
+            # no evasion: checkmate
+            return alpha if has_legal_move else -eval_func.CHECKMATE_SCORE
+
+        # Stalemate is only tested when the static evaluation would be returned with no capture to try. Not on
+        # stand-pat cutoffs, the common case: the side to move would have to be stalemated while ahead
+        stand_pat = self._leaf_eval(hash_board, check_terminal=False)
+        if stand_pat >= beta:
+            return beta
+        # Delta pruning: if even winning a queen can't bring us up to alpha, no capture will
+        big_delta = eval_func.PIECE_VALUES[chess.QUEEN] + self.DELTA_MARGIN
+        if stand_pat + big_delta / eval_func.PAWN_ADVANTAGE < alpha:
+            return alpha if any(board.generate_legal_moves()) else min(max(0.0, alpha), beta)
+        captures = self._get_capture_moves(board)
+        if not captures and not any(board.generate_legal_moves()):
+            return min(max(0.0, alpha), beta)
+        alpha = max(alpha, stand_pat)
+
+        for move in captures:
+            if move.promotion is None:
+                # Delta pruning per move: skip captures whose material gain can't raise alpha
+                captured_type = board.piece_type_at(move.to_square) or chess.PAWN  # None means en passant
+                gain = eval_func.PIECE_VALUES[captured_type] + self.DELTA_MARGIN
+                if stand_pat + gain / eval_func.PAWN_ADVANTAGE <= alpha:
+                    continue
+            hash_board.make_move(move)
+            evaluation = -self._quiescence(hash_board, alpha=-beta, beta=-alpha)
+            hash_board.undo_move()
+            if evaluation >= beta:
+                return beta
+            alpha = max(alpha, evaluation)
+        return alpha
+
+    @staticmethod
+    def _leaf_eval(hash_board: HashBoard, check_terminal: bool) -> float:
+        # Static evaluation from the side to move's perspective. check_terminal=False leaves checkmate and stalemate
+        # to the caller, e.g. a search that finds no legal move
+        perspective = 1 if hash_board.turn() else -1
+        return perspective * hash_board.evaluate(check_terminal=check_terminal)
+
+    """
+    Search budget & principal variation
+    """
+    def _budget_exhausted(self) -> bool:
+        if self._cur_node_limit is not None and self._num_nodes + self._num_qnodes >= self._cur_node_limit:
+            return True
+        return self._deadline is not None and default_timer() >= self._deadline
+
+    def _check_budget(self):
+        # Node limit is cheap to check every node. Reading the clock is not, so only do it every so often
+        total_nodes = self._num_nodes + self._num_qnodes
+        if self._cur_node_limit is not None and total_nodes >= self._cur_node_limit:
+            raise SearchAborted()
+        if self._deadline is not None and total_nodes % self.TIME_CHECK_INTERVAL == 0:
+            if default_timer() >= self._deadline:
+                raise SearchAborted()
+
+    def _store_pv(self, board: chess.Board, pv: list, depth: int):
+        # Replays pv from the root, remembering which move to try first in each position along the line.
+        # The pv table line is cut short by transposition table hits, so we extend it with the table's best moves
+        self._pv_moves = dict()
+        self._pv_line = list(pv)
+        hash_board = HashBoard(board.copy(), self._zobrist_hasher)
+        for move in pv:
+            self._pv_moves[hash_board.get_position_hash()] = move
+            hash_board.make_move(move)
+        while len(self._pv_line) < depth:
+            entry = self._transposition_table.get(hash_board.get_position_hash())
+            if entry is None or entry.best_move is None or hash_board.get_position_hash() in self._pv_moves:
+                break
+            if not hash_board.get_shallow_copy().is_legal(entry.best_move):
+                break
+            self._pv_moves[hash_board.get_position_hash()] = entry.best_move
+            self._pv_line.append(entry.best_move)
+            hash_board.make_move(entry.best_move)
+
     """
     Helper Functions
     """
     def _get_ordered_move_lst(self, board: chess.Board):
+        # Only used by _minimax now; _negamax orders moves with move_order.staged_move_generator
         move_score_lst = []
         # self._compute_opp_pawn_attacks(board)
         for move in board.legal_moves:
@@ -207,11 +778,28 @@ class MinimaxBot(Agent):
             if board.attackers(opp, square) & board.pawns:
                 self._opp_pawn_attacks.add(square)
 
-    # use this to generate capture moves
+    # use this to generate capture moves (and promotions), ordered by MVV-LVA
     def _get_capture_moves(self, board: chess.Board):
-        capture_moves = []
-        for move in board.legal_moves:
-            # if we made en passant capture or move to a square occupied by enemy piece, we made capture
-            if board.is_en_passant(move) or board.piece_type_at(move.to_square) is not None:
-                capture_moves.append(move)
-        return capture_moves
+        return move_order.get_ordered_capture_lst(board)
+
+
+def _lazy_smp_worker(args):
+    """
+    Entry point of a lazy SMP worker process. Builds a bot around the shared transposition table and runs
+    iterative deepening on the root position, starting from the main process's move ordering tables (heuristics).
+    Returns (worker id, best move uci, stats, eval, heuristics after the search); heuristics only for worker 0
+    """
+    (worker_id, position, hasher, tt_name, tt_size_mb, tt_age, config, heuristics,
+     wall_deadline, node_limit, max_depth) = args
+    transposition_table = TranspositionTable.attach_shared(hasher, tt_name, size_mb=tt_size_mb, age=tt_age)
+    bot = MinimaxBot(name=f"lazy_smp_worker_{worker_id}", hasher=hasher, transposition_table=transposition_table,
+                     heuristics=heuristics, **config)
+    if worker_id > 0:
+        bot.get_search_heuristics().perturb_history(seed=worker_id)
+    # wall clock deadline of the main process, on our own timer
+    deadline = None if wall_deadline is None else default_timer() + wall_deadline - time.time()
+    best_move, best_eval = bot._iterative_deepening(position, deadline, node_limit, max_depth,
+                                                    first_depth=1 + worker_id % 2)
+    stats = bot._collect_search_stats()
+    transposition_table.close()
+    return worker_id, best_move.uci(), stats, best_eval, bot.get_search_heuristics() if worker_id == 0 else None
@@ -9,127 +9,610 @@ import chess
 from playground.read_only_board import ReadOnlyBoard
 from playground.hash_board import HashBoard
 from agents import Agent
+from agents.minimax_bot import MinimaxBot
 from agents.evaluation import eval_func
+from agents.evaluation import batch_eval
+from agents.evaluation.eval_cache import EvalCache
+from agents.evaluation.pawn_hash_table import PawnHashTable
+from agents.search import move_order
 from agents.search.zobrist_hash import ZobristHash
-from agents.search.hash_tree import HashTree
+from agents.search.hash_tree import HashTree, TreeNode
+from agents.search.array_hash_tree import ArrayHashTree
 
-import random
+import numpy as np
 import math
+import enum
+import multiprocessing
 from timeit import default_timer  # For runtime profiling
 
 
+class ParallelMode(enum.Enum):
+    ROOT = "root"  # each worker builds its own tree, statistics of the root's children are summed
+    TREE = "tree"  # workers search one tree in shared memory, spread out by virtual loss
+
+
+class SelectionMode(enum.Enum):
+    THOMPSON = "thompson"  # Thompson sampling over every legal move
+    PUCT = "puct"  # PUCT with move ordering scores as priors, over a progressively widened set of moves
+
+
+class StopReason(enum.Enum):
+    SIM_LIMIT = "sim_limit"  # ran all simulations of the budget
+    TIME_LIMIT = "time_limit"
+    LEADER_UNREACHABLE = "leader_unreachable"  # no other move can catch up with the leader in the remaining budget
+    ROOT_CHILD_DETERMINED = "root_child_determined"  # a root move is a known win
+    ROOT_DETERMINED = "root_determined"  # result of the root position is known
+    SINGLE_MOVE = "single_move"  # only one legal move
+    TREE_FULL = "tree_full"  # shared tree ran out of room
+
+
 class MonteCarloBot(Agent):
-    def __init__(self, name="mtcs_bot"):
+    """
+    seed (int)           : seed of the random generator used for Thompson sampling and tie breaks. Runs with the same
+                           seed from the same position pick the same moves
+    max_tree_nodes (int) : cap on the size of the search tree; least visited nodes are evicted past it. None for no cap.
+                           In tree-parallel mode, the fixed capacity of the shared tree (default SHARED_TREE_NODES),
+                           at least 2 * num_workers * batch_size
+    use_array_tree (bool): store the tree in NumPy arrays (ArrayHashTree) instead of one Python object per node.
+                           Much smaller per node, so bigger trees fit in memory
+    num_workers (int)    : number of processes running simulations. 1 searches in this process
+    parallel_mode        : ParallelMode (or its value, "root" / "tree") used when num_workers > 1
+    use_virtual_loss (bool) : count simulations in flight as losses during selection (set for tree-parallel workers)
+    hasher, game_tree    : hasher and tree to use instead of new ones (e.g. a worker attached to a shared tree)
+    batch_size (int)     : number of new leaves gathered (with virtual loss) and evaluated together. 1 evaluates
+                           each leaf as soon as it is reached
+    batch_evaluator      : callable scoring a (K, 12, 64) piece plane tensor, see agents.evaluation.batch_eval.
+                           MaterialPSTEvaluator (same scores as the one-by-one evaluation) if None
+    time_limit (float)   : seconds per move. None for no time limit
+    sim_limit (int)      : simulations per move. None for no limit; DEFAULT_NUM_SIM if there's no time limit either
+    selection_mode       : SelectionMode (or its value, "thompson" / "puct") used to pick the move to follow
+    move_prior           : function (chess.Board, chess.Move) -> score in pawns, turned into PUCT priors by a softmax.
+                           move_order.simple_score_move if None; move_order.score_move is slower but sees more
+    leaf_search_depth (int) : score new leaves with a fixed depth negamax (MinimaxBot's search) instead of the static
+                              evaluation, so hanging pieces are seen. 0 runs a quiescence search only. None for the
+                              static evaluation. Not available with batch_size > 1
+    leaf_node_limit (int)   : most nodes a leaf search may take; leaves needing more get the static evaluation.
+                              None for no limit
+    leaf_cache_mb (float)   : memory budget of the transposition table caching leaf search results, kept between moves
+    use_pawn_structure (bool) : add pawn structure terms to the evaluation of leaves, cached in the PawnHashTable of
+                                the hasher. Not available with batch_size > 1
+    use_activity (bool)  : add mobility and king safety terms to the evaluation of leaves (see
+                           agents.evaluation.bitboard_eval). Not available with batch_size > 1
+    nnue (NNUEEvaluator) : evaluate leaves with this network instead of eval_func (see agents.evaluation.nnue_eval).
+                           Also the batch evaluator, unless another one is given
+
+    In PUCT mode, moves of a node are sorted by prior and only the best width(N) = PW_INITIAL_WIDTH +
+    PW_FACTOR * N^PW_EXPONENT of them can be selected after N visits, so simulations are not spread thin over
+    every legal move. The move played is then the most visited one.
+
+    Search is anytime: besides the budget running out, it stops early when (in PUCT mode) the move with the most
+    simulations can no longer be caught up with in the remaining budget, when a root move is a known win, when the
+    result of the root is known, or when there is only one legal move. The stopping rule used is reported in
+    get_search_stats().
+
+    The tree is kept between moves: it is re-rooted at the position to move from (after our move and after the
+    opponent's), so statistics of the reachable subtree carry over and the rest is dropped.
+    """
+    PATH_STACK_SIZE = 256  # initial size of the simulation path stacks; they grow if a path gets longer
+    SHARED_TREE_NODES = 1 << 18
+    DEFAULT_NUM_SIM = 1000
+    STOP_CHECK_INTERVAL = 64  # simulations between checks of the early stopping rules
+    C_PUCT = 1.0  # weight of the prior term in PUCT; win rates are in [0, 1]
+    PRIOR_TEMPERATURE = 3.0  # pawns; move scores are divided by it before the softmax
+    PW_INITIAL_WIDTH = 3
+    PW_FACTOR = 1.0
+    PW_EXPONENT = 0.5
+    LEAF_CACHE_MB = 4
+    LEAF_NODE_LIMIT = 200
+
+    def __init__(self, name="mtcs_bot", seed=None, max_tree_nodes=None, use_array_tree=False, num_workers=1,
+                 parallel_mode=ParallelMode.ROOT, use_virtual_loss=False, hasher=None, game_tree=None,
+                 batch_size=1, batch_evaluator=None, time_limit=None, sim_limit=None,
+                 selection_mode=SelectionMode.THOMPSON, move_prior=None, leaf_search_depth=None,
+                 leaf_cache_mb=LEAF_CACHE_MB, leaf_node_limit=LEAF_NODE_LIMIT, use_pawn_structure=False,
+                 use_activity=False, nnue=None):
         super().__init__(name)
+        self._rng = np.random.default_rng(seed)
         self._num_pos_searched = 0
-        self._zobrist_hasher = ZobristHash()
-        self._game_tree = HashTree(self._zobrist_hasher)
+        self._zobrist_hasher = ZobristHash() if hasher is None else hasher
+        self._num_workers = num_workers
+        self._parallel_mode = ParallelMode(parallel_mode)
+        self._selection_mode = SelectionMode(selection_mode)
+        self._move_prior = move_order.simple_score_move if move_prior is None else move_prior
+        self._batch_size = batch_size
+        if batch_evaluator is None:
+            batch_evaluator = batch_eval.MaterialPSTEvaluator() if nnue is None else nnue
+        self._batch_evaluator = batch_evaluator
+        # piece bitboards of the leaves in the current batch
+        self._batch_bitboards = np.zeros((batch_size, batch_eval.NUM_PLANES), dtype=np.uint64)
+        self._num_batches = 0
+        self._num_collisions = 0
+        # simulations in a batch are in flight together, so they need virtual loss to spread out
+        self._use_virtual_loss = use_virtual_loss or batch_size > 1
+        if leaf_search_depth is not None and batch_size > 1:
+            raise RuntimeError("Leaf search evaluates one leaf at a time. Use batch_size=1 with leaf_search_depth!")
+        if use_pawn_structure and batch_size > 1:
+            raise RuntimeError("Batch evaluators have no pawn structure terms. Use batch_size=1 with use_pawn_structure!")
+        if use_activity and batch_size > 1:
+            raise RuntimeError("Batch evaluators have no activity terms. Use batch_size=1 with use_activity!")
+        self._pawn_table = PawnHashTable.for_hasher(self._zobrist_hasher) if use_pawn_structure else None
+        self._use_activity = use_activity
+        self._nnue = nnue
+        self._leaf_search_depth = leaf_search_depth
+        self._leaf_node_limit = leaf_node_limit
+        self._leaf_searcher = None
+        if leaf_search_depth is not None:
+            # Only its search code and transposition table are used, as a cache of leaf evaluations
+            self._leaf_searcher = MinimaxBot(name=f"{name}_leaf_search", tt_size_mb=leaf_cache_mb,
+                                             hasher=self._zobrist_hasher)
+        self._tree_lock = None
+        if game_tree is not None:
+            self._game_tree = game_tree
+        elif num_workers > 1 and self._parallel_mode == ParallelMode.TREE:
+            shared_tree_nodes = self.SHARED_TREE_NODES if max_tree_nodes is None else max_tree_nodes
+            # after evicting half the tree, there must be room for one batch of simulations per worker
+            if 2 * num_workers * batch_size > shared_tree_nodes:
+                raise RuntimeError(f"Shared tree of {shared_tree_nodes} nodes is too small for {num_workers} workers "
+                                   f"with batch_size={batch_size}. Use max_tree_nodes >= "
+                                   f"{2 * num_workers * batch_size}!")
+            self._tree_lock = multiprocessing.Lock()
+            self._game_tree = ArrayHashTree.create_shared(self._zobrist_hasher, shared_tree_nodes,
+                                                          virtual_loss_rows=num_workers, lock=self._tree_lock,
+                                                          batch_size=batch_size)
+        elif use_array_tree:
+            self._game_tree = ArrayHashTree(self._zobrist_hasher, max_nodes=max_tree_nodes,
+                                            virtual_loss_rows=1 if self._use_virtual_loss else 0)
+        else:
+            self._game_tree = HashTree(self._zobrist_hasher, max_nodes=max_tree_nodes)
+        # Settings handed to root-parallel workers, which build their own bot
+        self._worker_config = dict(max_tree_nodes=max_tree_nodes, use_array_tree=use_array_tree, batch_size=batch_size,
+                                   batch_evaluator=batch_evaluator, selection_mode=self._selection_mode,
+                                   move_prior=move_prior, leaf_search_depth=leaf_search_depth,
+                                   leaf_cache_mb=leaf_cache_mb, leaf_node_limit=leaf_node_limit,
+                                   use_pawn_structure=use_pawn_structure, use_activity=use_activity, nnue=nnue)
         self._cur_transposition_cnt = 0
+        self._num_nodes_dropped = 0
+        self._time_limit = time_limit
+        self._sim_limit = sim_limit
+        self._num_sims = 0
+        self._search_stats = dict()
+        # Nodes on the current simulation's path, and index of the move chosen at each
+        self._path_nodes = [None] * self.PATH_STACK_SIZE
+        self._path_indices = [0] * self.PATH_STACK_SIZE
 
-    def get_move(self, read_only_board: ReadOnlyBoard) -> chess.Move:
+    def get_move(self, read_only_board: ReadOnlyBoard, time_limit=None, sim_limit=None) -> chess.Move:
+        """
+        Searches until the time / simulation budget runs out, or an early stopping rule applies.
+        Budget arguments override the bot's defaults for this call only
+        """
+        time_limit = self._time_limit if time_limit is None else time_limit
+        sim_limit = self._sim_limit if sim_limit is None else sim_limit
         self._num_pos_searched = 0
+        self._num_nodes_dropped = 0
+        self._num_batches = 0
+        self._num_collisions = 0
+        leaf_nodes_before = self._leaf_search_nodes()
+        eval_cache = EvalCache.for_hasher(self._zobrist_hasher)
+        cache_hits, cache_misses = eval_cache.hits, eval_cache.misses
+        pawn_counts = (0, 0) if self._pawn_table is None else (self._pawn_table.hits, self._pawn_table.misses)
         # Get start time
         start_time = default_timer()
 
-        hash_board = HashBoard(read_only_board.get_copy(), hasher=self._zobrist_hasher)
+        hash_board = HashBoard(read_only_board.get_copy(), hasher=self._zobrist_hasher, pawn_table=self._pawn_table,
+                               nnue=self._nnue, use_activity=self._use_activity)
         root_key = hash_board.get_position_hash()
+        # Drop what the opponent's move made unreachable, keep the rest of the tree
+        self._num_nodes_dropped += self._game_tree.reroot(root_key)
+        reused_nodes = self._game_tree.size()
         # Now, run MTCS
-        self.run_mtcs(hash_board=hash_board, root_key=root_key, num_sim=1000)
-
-        best_move, best_eval = self.find_best_move_and_eval(hash_board)
+        best_move, best_eval, stop_reason = self.search(hash_board, num_sim=sim_limit, time_limit=time_limit)
+        # Keep only the subtree of the move we play
+        hash_board.make_move(best_move)
+        self._num_nodes_dropped += self._game_tree.reroot(hash_board.get_position_hash())
+        hash_board.undo_move()
         duration = default_timer() - start_time
+        self._search_stats = {"simulations": self._num_sims, "positions": self._num_pos_searched,
+                              "stop_reason": stop_reason.value, "time": duration,
+                              "sims_per_sec": self._num_sims / duration if duration > 0 else 0.0,
+                              "tree_size": self._game_tree.size(), "nodes_reused": reused_nodes,
+                              "nodes_dropped": self._num_nodes_dropped, "batches": self._num_batches,
+                              "batch_collisions": self._num_collisions,
+                              "leaf_search_nodes": self._leaf_search_nodes() - leaf_nodes_before,
+                              "eval_cache_hits": eval_cache.hits - cache_hits,
+                              "eval_cache_misses": eval_cache.misses - cache_misses}
+        if self._pawn_table is not None:
+            self._search_stats["pawn_table_hits"] = self._pawn_table.hits - pawn_counts[0]
+            self._search_stats["pawn_table_misses"] = self._pawn_table.misses - pawn_counts[1]
 
         # Print num pos searched
         print(f"***\n'{self.get_name()}' searched through {self._num_pos_searched} positions. Best eval: {best_eval}.")
+        print(f"Ran {self._num_sims} simulations, stopped by {stop_reason.value}.")
+        if self._batch_size > 1:
+            print(f"Evaluated leaves in {self._num_batches} batches of up to {self._batch_size}, "
+                  f"{self._num_collisions} simulations dropped on colliding leaves.")
+        if self._leaf_searcher is not None:
+            print(f"Leaf search (depth {self._leaf_search_depth}) ran "
+                  f"{self._search_stats['leaf_search_nodes']} nodes.")
+        print(f"Tree: reused {reused_nodes} nodes, dropped {self._num_nodes_dropped}, "
+              f"kept {self._game_tree.size()} for next move.")
+        print(f"Eval cache: {self._search_stats['eval_cache_hits']} hits, "
+              f"{self._search_stats['eval_cache_misses']} misses.")
+        if self._pawn_table is not None:
+            print(f"Pawn table: {self._search_stats['pawn_table_hits']} hits, "
+                  f"{self._search_stats['pawn_table_misses']} misses.")
+        if self._num_workers > 1:
+            print(f"{self._parallel_mode.value}-parallel search with {self._num_workers} workers.")
         print("***")
         # Print time taken
         print(f"### SYS INFO: time taken for move generation: {duration} ###")
         return best_move
 
-    def run_mtcs(self, hash_board: HashBoard, root_key, num_sim=1000):
+    def _leaf_search_nodes(self) -> int:
+        # nodes searched by leaf searches of this process so far
+        return 0 if self._leaf_searcher is None else self._leaf_searcher.num_nodes_searched()
+
+    def get_search_stats(self) -> dict:
+        """
+        Returns statistics of the last get_move (simulations, positions added, stop reason, time, sims/sec,
+        tree size, nodes reused from the previous move and dropped)
+        """
+        return self._search_stats
+
+    def search(self, hash_board: HashBoard, num_sim=None, time_limit=None) -> (chess.Move, float, StopReason):
+        """
+        Runs up to num_sim simulations / time_limit seconds from the position of hash_board (split between
+        the workers, if any). Returns the best move, its eval (white's perspective) and why the search stopped
+        """
+        if num_sim is None and time_limit is None:
+            num_sim = self.DEFAULT_NUM_SIM
+        self._num_sims = 0
+        if self._num_workers > 1 and self._parallel_mode == ParallelMode.ROOT:
+            return self._root_parallel_search(hash_board, num_sim, time_limit)
+        if self._num_workers > 1:
+            stop_reason = self._tree_parallel_search(hash_board, num_sim, time_limit)
+        else:
+            deadline = None if time_limit is None else default_timer() + time_limit
+            stop_reason = self.run_mtcs(hash_board=hash_board, root_key=hash_board.get_position_hash(),
+                                        num_sim=num_sim, deadline=deadline)
+        return *self.find_best_move_and_eval(hash_board), stop_reason
+
+    def run_mtcs(self, hash_board: HashBoard, root_key, num_sim=1000, deadline=None) -> StopReason:
+        """
+        Runs simulations until num_sim (None for no limit) have run, the deadline (timer value) passes,
+        or an early stopping rule applies. Returns the reason for stopping
+        """
         self._game_tree.cur_root_key = root_key
+        start_time = default_timer()
+        num_root_moves = hash_board.legal_moves().count()
 
         # Now, run mtcs 4-step process num_sim times
-        for i in range(num_sim):
-            self.recursive_tree_search(hash_board)
+        num_run = 0
+        next_check = self.STOP_CHECK_INTERVAL
+        while True:
+            if num_sim is not None and num_run >= num_sim:
+                return StopReason.SIM_LIMIT
+            if deadline is not None and default_timer() >= deadline:
+                return StopReason.TIME_LIMIT
+            if not self._game_tree.has_room(self._batch_size):
+                return StopReason.TREE_FULL  # shared tree can't be garbage collected while other workers search it
+            if num_root_moves == 1 and num_run >= 2:
+                # root is in the tree and expanded, so there is an eval to report
+                return StopReason.SINGLE_MOVE
+            if num_run >= next_check:
+                next_check += self.STOP_CHECK_INTERVAL
+                stop_reason = self._check_early_stop(root_key, num_root_moves, num_sim, num_run, deadline, start_time)
+                if stop_reason is not None:
+                    return stop_reason
 
-    def recursive_tree_search(self, hash_board: HashBoard):
+            if self._batch_size > 1:
+                batch = self._batch_size if num_sim is None else min(self._batch_size, num_sim - num_run)
+                self.simulate_batch(hash_board, batch)
+            else:
+                batch = 1
+                self.simulate(hash_board)
+            # dropped simulations count too, so a budget in simulations always runs out
+            num_run += batch
+            self._num_sims += batch
+            if self._game_tree.is_full():
+                self._num_nodes_dropped += self._game_tree.evict()
+
+    def _check_early_stop(self, root_key, num_root_moves, num_sim, num_run, deadline, start_time) -> StopReason | None:
+        root = self._game_tree.get(root_key)
+        if root is None:
+            return None
+        for child_key in root.children.values():
+            child = self._game_tree.get(child_key)
+            if child is not None and child.outcome_score == 0:
+                return StopReason.ROOT_CHILD_DETERMINED  # the opponent is lost after this move
+        if root.outcome_score is not None:
+            return StopReason.ROOT_DETERMINED
+
+        # simulations left in the budget; for a time limit, estimated from the speed so far
+        remaining = math.inf if num_sim is None else num_sim - num_run
+        if deadline is not None:
+            now = default_timer()
+            remaining = min(remaining, num_run * (deadline - now) / max(now - start_time, 1e-9))
+        # Only PUCT plays the most visited move. Thompson sampling plays the best expectation, which any simulation
+        # can change, so visit counts say nothing about whether the move played is settled
+        if remaining == math.inf or num_root_moves < 2 or self._selection_mode != SelectionMode.PUCT:
+            return None
+        # Leader is the move find_best_move_and_eval would play, ranked by the same key on total visits (including
+        # those reused from earlier searches). Runner-up is the most visited other move that can still be selected
+        leader_rank, leader_key = None, None
+        for child_key in root.children.values():
+            child = self._game_tree.get(child_key)
+            if child is not None:
+                rank = self._move_rank(1 - child.expectation(), self._rank_visits(child))
+                if leader_rank is None or rank > leader_rank:
+                    leader_rank, leader_key = rank, child_key
+        if leader_rank is None or not leader_rank[1]:
+            return None  # nothing searched yet, or every searched move is a known loss
+        runner_up_visits = 0
+        for child_key in root.children.values():
+            child = self._game_tree.get(child_key)
+            if child_key != leader_key and child is not None and child.outcome_score is None:
+                runner_up_visits = max(runner_up_visits, child.visits())
+        if leader_rank[2] - runner_up_visits > remaining:
+            return StopReason.LEADER_UNREACHABLE
+        return None
+
+    def _worker_args(self, num_sim) -> list:
+        # (worker id, simulations, seed) of each worker. Seeds come from our generator, so seeded runs reproduce
+        return [(worker_id,
+                 None if num_sim is None else num_sim // self._num_workers + (worker_id < num_sim % self._num_workers),
+                 int(self._rng.integers(1 << 63)))
+                for worker_id in range(self._num_workers)]
+
+    def _root_parallel_search(self, hash_board: HashBoard, num_sim, time_limit) -> (chess.Move, float, StopReason):
         """
-        Current code is VERY inefficient
+        Each worker builds its own tree from the root position. Wins and visits of each root child are then
+        summed over the workers, and the child with the best combined expectation is played.
+        Reports the stop reason of the first worker
         """
-        key = hash_board.get_position_hash()
-        ply_cnt = hash_board.ply()
-        is_white = hash_board.turn()
-        # node: current node we are at
-        node = self._game_tree.get(key)
+        board = hash_board.get_deep_copy()
+        args = [(worker_id, board, self._worker_config, worker_sims, time_limit, seed)
+                for worker_id, worker_sims, seed in self._worker_args(num_sim)]
+        with multiprocessing.Pool(processes=self._num_workers) as pool:
+            results = pool.map(_root_parallel_worker, args)
+
+        merged = dict()  # move uci -> [wins, visits, outcome], from the root player's perspective
+        for worker_id, num_pos_searched, num_sims, stop_reason, child_stats in results:
+            self._num_pos_searched += num_pos_searched
+            self._num_sims += num_sims
+            for move_uci, (wins, visits, outcome) in child_stats.items():
+                stats = merged.setdefault(move_uci, [0.0, 0.0, None])
+                stats[0] += wins
+                stats[1] += visits
+                if outcome is not None:
+                    stats[2] = outcome
+
+        best_move, best_expectation, best_eval = None, -1, 0.0
+        for move_uci, (wins, visits, outcome) in merged.items():
+            combined = TreeNode(None, hash_board.ply())
+            combined.param = (wins + 1, visits - wins + 1)
+            combined.outcome_score = outcome
+            if combined.expectation() > best_expectation:
+                best_move = chess.Move.from_uci(move_uci)
+                best_expectation = combined.expectation()
+                best_eval = combined.pawn_advantage()
+        if best_move is None:
+            # no worker got past the root (e.g. num_sim below num_workers)
+            best_move = next(iter(hash_board.legal_moves()))
+        perspective = 1 if hash_board.turn() else -1
+        return best_move, perspective * best_eval, StopReason(results[0][3])
+
+    def _tree_parallel_search(self, hash_board: HashBoard, num_sim, time_limit) -> StopReason:
+        # Workers attach to our shared tree and run their simulations on it. Results are read from the tree after.
+        # Returns the stop reason of the first worker
+        self._game_tree.cur_root_key = hash_board.get_position_hash()
+        # Halve the tree until workers have room again. Kept nodes are the most visited, so they hold most edges
+        target_size = self._game_tree.capacity() // 2
+        while not self._game_tree.has_room(self._batch_size) and self._game_tree.size() > 1:
+            self._num_nodes_dropped += self._game_tree.evict(target_size)
+            target_size //= 2
+        if self._game_tree.get(hash_board.get_position_hash()) is None:
+            # added here, so there is a root to pick a move from even if no worker gets to run a simulation
+            self.add_leaf(hash_board)
+        board = hash_board.get_deep_copy()
+        # workers search our tree, so they only need the settings of the search itself
+        config = {setting: value for setting, value in self._worker_config.items()
+                  if setting not in ("max_tree_nodes", "use_array_tree")}
+        args = [(worker_id, board, self._zobrist_hasher, self._game_tree.shared_memory_name(),
+                 self._game_tree.capacity(), self._num_workers, config, worker_sims, time_limit, seed)
+                for worker_id, worker_sims, seed in self._worker_args(num_sim)]
+        with multiprocessing.Pool(processes=self._num_workers, initializer=_set_worker_lock,
+                                  initargs=(self._tree_lock,)) as pool:
+            results = pool.map(_tree_parallel_worker, args)
+        self._num_pos_searched += sum(result[1] for result in results)
+        self._num_sims += sum(result[2] for result in results)
+        return StopReason(results[0][3])
+
+    def get_root_child_stats(self, hash_board: HashBoard) -> dict:
+        """
+        Returns {move uci: (wins, visits, outcome)} of the searched children of hash_board's position,
+        all from the perspective of the player to move there. outcome is None unless the result is known
+        """
+        node = self._game_tree.get(hash_board.get_position_hash())
         if node is None:
-            # If node is not on the tree, add to tree, make static eval, compute param, return
-            # add one to the count of nodes
+            return dict()
+        child_stats = dict()
+        for move, child_key in node.children.items():
+            child = self._game_tree.get(child_key)
+            # child's losses are our wins
+            child_outcome = child.outcome_score
+            child_stats[move.uci()] = (child.param[1] - 1, child.visits(),
+                                       None if child_outcome is None else 1 - child_outcome)
+        return child_stats
+
+    def close(self):
+        # Releases the shared memory tree, if any
+        if isinstance(self._game_tree, ArrayHashTree):
+            self._game_tree.close()
+
+    def simulate(self, hash_board: HashBoard):
+        """
+        One simulation: select moves down the tree until reaching a position not in the tree,
+        add and evaluate it, then back-propagate win rates up the path.
+        Iterative: the path (node, index of move chosen) is kept in preallocated stacks, reused between simulations.
+        Returns index of the root move chosen, or None if the simulation stopped at the root
+        """
+        depth, reached_new_position = self._select_path(hash_board)
+        if reached_new_position:
+            self.add_leaf(hash_board)
+        root_index = self._path_indices[0] if depth else None
+        self._back_propagate_path(hash_board, depth)
+        return root_index
+
+    def simulate_batch(self, hash_board: HashBoard, num_sim: int) -> list:
+        """
+        Runs num_sim simulations whose new leaves are evaluated together in one call of the batch evaluator.
+        Leaves are gathered first (virtual loss keeps the simulations apart), then evaluated and back-propagated.
+        A simulation reaching a leaf already pending in the batch is dropped. Returns index of the root move
+        chosen by each simulation that was not dropped (None if it stopped at the root)
+        """
+        pending = []  # (key, ply, turn, path) of each leaf waiting for evaluation
+        pending_keys = set()
+        root_indices = []
+        for i in range(num_sim):
+            depth, reached_new_position = self._select_path(hash_board)
+            key = hash_board.get_position_hash()
+            if not reached_new_position or hash_board.outcome() is not None:
+                # nothing to evaluate (a known result, or game over): back-propagate right away
+                if reached_new_position:
+                    self.add_leaf(hash_board)
+                root_indices.append(self._path_indices[0] if depth else None)
+                self._back_propagate_path(hash_board, depth)
+                continue
+
+            path = list(zip(self._path_nodes[:depth], self._path_indices[:depth]))
+            if key in pending_keys:
+                self._num_collisions += 1
+                for node, index in path:
+                    node.remove_virtual_loss(index)
+            else:
+                self._batch_bitboards[len(pending)] = batch_eval.board_bitboards(hash_board.get_shallow_copy())
+                pending.append((key, hash_board.ply(), hash_board.turn(), path))
+                pending_keys.add(key)
+            for _ in range(depth):
+                hash_board.undo_move()
+            self._path_nodes[:depth] = [None] * depth
+
+        if not pending:
+            return root_indices
+        self._num_batches += 1
+        planes = batch_eval.bitboards_to_planes(self._batch_bitboards[:len(pending)])
+        scores = self._batch_evaluator(planes)
+        for (key, ply, turn, path), score in zip(pending, scores):
             self._num_pos_searched += 1
+            self._game_tree.add(key, ply)
+            perspective = 1 if turn else -1
+            self._game_tree.get(key).update_param_from_score(perspective * float(score))
+            for node, index in reversed(path):
+                node.remove_virtual_loss(index)
+                self.back_propagate(node, index)
+            root_indices.append(path[0][1] if path else None)
+        return root_indices
 
-            self._game_tree.add(key, ply_cnt)
+    def _select_path(self, hash_board: HashBoard) -> (int, bool):
+        """
+        Selection: walks down the tree from hash_board's position until it falls off the tree, or reaches a position
+        whose result is known, or that is already on the path. Moves are made on hash_board and recorded in the path
+        stacks. Returns the number of moves made, and whether the position reached is not in the tree
+        """
+        path_nodes = self._path_nodes
+        path_indices = self._path_indices
+        path_keys = set()
+        depth = 0
+        while True:
+            key = hash_board.get_position_hash()
             node = self._game_tree.get(key)
-            outcome = hash_board.outcome()
-            if outcome is not None:
-                if hash_board.get_shallow_copy().is_checkmate():
-                    node.param = (1.0, 2 * eval_func.CHECKMATE_SCORE)
-                    node.outcome_score = 0
-                else:
-                    node.param = (2 * eval_func.CHECKMATE_SCORE, 2 * eval_func.CHECKMATE_SCORE)
-                    node.outcome_score = 0.5
+            if node is None:
+                return depth, True
+            if node.outcome_score is not None:
+                # nothing left to learn below this node; its parent's statistics get refreshed on the way up
+                return depth, False
+            if key in path_keys:
+                # Positions repeat, so the tree has cycles. PUCT is deterministic: it would go round the cycle forever
+                return depth, False
+            path_keys.add(key)
+            if not node.is_expanded():
+                # First visit: make and unmake each move once, and cache the resulting keys on the node
+                self.expand_node(node, hash_board)
+            if self._selection_mode == SelectionMode.PUCT:
+                index = node.select_child_puct(self._rng, self.C_PUCT, self.widening_width(node.visits()))
             else:
-                perspective = 1 if is_white else -1
-                pawn_advantage = perspective * eval_func.evaluate(hash_board.get_shallow_copy())
-                node.update_param_from_score(pawn_advantage)
-            return
+                # Select next state to explore from all legal moves, by Thompson sampling all children at once
+                index = node.select_child(self._rng)
+            if depth == len(path_nodes):
+                path_nodes.extend([None] * len(path_nodes))
+                path_indices.extend([0] * len(path_indices))
+            path_nodes[depth] = node
+            path_indices[depth] = index
+            depth += 1
+            if self._use_virtual_loss:
+                node.add_virtual_loss(index)
+            hash_board.make_move(node.move_at(index))
 
-        move_chosen = None
-        resulting_key = None
-        thompson_sample = -1
-        # Select next state to explore from all legal moves
-        for move in hash_board.legal_moves():
-            # naive and VERY inefficient implementation: we make and unmake each move
-            # make the move
-            hash_board.make_move(move)
-            child = self._game_tree.get(hash_board.get_position_hash())
-            if child is None:
-                cur_sample = node.sample()
-                if cur_sample > thompson_sample:
-                    thompson_sample = cur_sample
-                    move_chosen = move
-                    resulting_key = hash_board.get_position_hash()
-            elif child.outcome_score is None:
-                # we take advantage of the fact that beta(a, b) = 1 - beta(b, a)
-                cur_sample = 1 - child.sample()
-                if cur_sample > thompson_sample:
-                    thompson_sample = cur_sample
-                    move_chosen = move
-                    resulting_key = hash_board.get_position_hash()
-            # undo it
+    def _back_propagate_path(self, hash_board: HashBoard, depth: int):
+        # Back-propagation, from the deepest node on the path up to the root, undoing the moves on the way
+        path_nodes = self._path_nodes
+        path_indices = self._path_indices
+        while depth > 0:
+            depth -= 1
+            node = path_nodes[depth]
+            path_nodes[depth] = None
             hash_board.undo_move()
+            if self._use_virtual_loss:
+                node.remove_virtual_loss(path_indices[depth])
+            self.back_propagate(node, path_indices[depth])
 
-        if move_chosen is None:
-            move_lst = list(hash_board.legal_moves())
-            random.shuffle(move_lst)
-            move_chosen = move_lst[0]
+    def add_leaf(self, hash_board: HashBoard):
+        # Adds position (not in the tree yet) to the tree, with parameters from its static eval or its result
+        self._num_pos_searched += 1
+        key = hash_board.get_position_hash()
+        self._game_tree.add(key, hash_board.ply())
+        node = self._game_tree.get(key)
+        outcome = hash_board.outcome()
+        if outcome is not None:
+            if hash_board.get_shallow_copy().is_checkmate():
+                node.param = (1.0, 2 * eval_func.CHECKMATE_SCORE)
+                node.outcome_score = 0
+            else:
+                node.param = (2 * eval_func.CHECKMATE_SCORE, 2 * eval_func.CHECKMATE_SCORE)
+                node.outcome_score = 0.5
+        else:
+            perspective = 1 if hash_board.turn() else -1
+            evaluation = None
+            if self._leaf_searcher is not None:
+                evaluation = self._leaf_searcher.evaluate_position(hash_board, self._leaf_search_depth,
+                                                                   self._leaf_node_limit)
+            if evaluation is None:
+                evaluation = hash_board.evaluate()
+            node.update_param_from_score(perspective * evaluation)
 
-        # Make move on board, explore node (call func), then undo move
-        hash_board.make_move(move_chosen)
-        # Win rate returned is next opp's win rate, so win rate for us should be 1 minus that.
-        self.recursive_tree_search(hash_board)
+    def back_propagate(self, node: TreeNode, index: int):
+        # Updates node after a simulation went through its child at index
         # Now that we searched the child, add it to the list of children
-        if self._game_tree.get(resulting_key) is not None:
-            node.children[move_chosen] = resulting_key
-        hash_board.undo_move()
+        child = self._game_tree.get(node.child_key_at(index))
+        if child is not None:
+            node.add_child(index)
+            node.update_child(index, child)
+            if node.best_child_index != TreeNode.NO_BEST_CHILD:
+                # we need to "negate" the win rate as it is
+                child_win_rate = 1 - child.win_rate_from_param()
+                if index == node.best_child_index and child_win_rate < node.best_child_win_rate:
+                    # the best child got worse; another child may be better now
+                    node.best_child_index = TreeNode.NO_BEST_CHILD
+                elif index == node.best_child_index or child_win_rate > node.best_child_win_rate:
+                    node.best_child_index = index
+                    node.best_child_win_rate = child_win_rate
+        if node.best_child_index == TreeNode.NO_BEST_CHILD:
+            self.find_best_child(node)
 
         # Perform appropriate back-prop. We first greedily choose the best move as the move that will be played
         # Then, we add the win rate (from our perspective) that will be provided by the best move
         # Note that we DO NOT care about what the best move is here
-        best_child_win_rate = node.win_rate_from_param()
-        for move, child_key in node.children.items():
-            # we need to "negate" the win rate as it is
-            cur_win_rate = 1 - self._game_tree.get(child_key).win_rate_from_param()
-            best_child_win_rate = max(cur_win_rate, best_child_win_rate)
+        best_child_win_rate = max(node.best_child_win_rate, node.win_rate_from_param())
         if best_child_win_rate == 1:
             # that means we have forced checkmate
             node.outcome_score = 1
@@ -138,36 +621,160 @@ class MonteCarloBot(Agent):
             node.outcome_score = 0
         else:
             node.update_param_from_win_rate(best_child_win_rate)
+            if child is not None and child.outcome_score is not None:
+                self._back_up_outcome(node)
+
+    def _back_up_outcome(self, node: TreeNode):
+        # When every move of node has a known result (e.g. all draws), so does node: the best of them.
+        # Simulations then stop at node instead of selecting solved moves
+        if not (node.child_state == TreeNode.DETERMINED).all():
+            return
+        children = [self._game_tree.get(child_key) for child_key in node.child_keys]
+        if any(child is None or child.outcome_score is None for child in children):
+            return
+        node.outcome_score = max(1 - child.outcome_score for child in children)
+
+    def find_best_child(self, node: TreeNode):
+        # Scans the searched children of node for the one with the best win rate from node's perspective.
+        # Only needed when the best child got worse (or was dropped); otherwise back_propagate keeps it up to date
+        node.best_child_index = TreeNode.NO_BEST_CHILD
+        node.best_child_win_rate = -np.inf
+        for index in node.searched_indices():
+            cur_win_rate = 1 - self._game_tree.get(node.child_key_at(index)).win_rate_from_param()
+            if cur_win_rate > node.best_child_win_rate:
+                node.best_child_index = index
+                node.best_child_win_rate = cur_win_rate
+
+    def expand_node(self, node: TreeNode, hash_board: HashBoard):
+        # hash_board must be at the node's position
+        moves = list(hash_board.legal_moves())
+        priors = None
+        if self._selection_mode == SelectionMode.PUCT:
+            moves, priors = self.move_priors(hash_board, moves)
+        child_keys = []
+        for move in moves:
+            hash_board.make_move(move)
+            child_keys.append(hash_board.get_position_hash())
+            hash_board.undo_move()
+        node.expand(moves, child_keys, [self._game_tree.get(child_key) for child_key in child_keys], priors)
+
+    def move_priors(self, hash_board: HashBoard, moves: list) -> (list, np.ndarray):
+        """
+        Softmax of the move_prior scores of moves (at PRIOR_TEMPERATURE).
+        Returns moves sorted by decreasing prior, and their priors
+        """
+        board = hash_board.get_shallow_copy()
+        scores = np.array([self._move_prior(board, move) for move in moves], dtype=np.float64)
+        priors = np.exp((scores - scores.max()) / self.PRIOR_TEMPERATURE)
+        priors /= priors.sum()
+        order = np.argsort(-priors, kind="stable")
+        return [moves[index] for index in order], priors[order]
+
+    def widening_width(self, visits: float) -> int:
+        # number of moves (best priors first) PUCT may select from, at a node with given number of visits
+        return self.PW_INITIAL_WIDTH + int(self.PW_FACTOR * max(visits, 0) ** self.PW_EXPONENT)
 
     def find_best_move_and_eval(self, hash_board: HashBoard) -> (chess.Move, float):
         # COMPLETE FUNCTION: returns best move in given position
         best_move = chess.Move.null()
-        best_expectation = -1
+        best_rank = (-1,)
         best_eval = -math.inf  # this eval is not static, but taken from perspective of the current player
         node = self._game_tree.get(hash_board.get_position_hash())
         if node is None:
             raise RuntimeError("Node doesn't exist in tree. Build Tree first!")
 
         move_lst = list(hash_board.legal_moves())
-        random.shuffle(move_lst)
+        self._rng.shuffle(move_lst)
+
+        # Unsearched moves are estimated from our statistics, not from our result if it is known (otherwise, once the
+        # root is a known win, every unsearched move would tie with the winning one). The estimate is capped by the
+        # worst searched child that is not a known loss: our statistics may come from a leaf search, which can rate
+        # the position above every move actually searched, and an unsearched move must never outrank them
+        unsearched_expectation = node.param[0] / (node.param[0] + node.param[1])
+        for child_key in node.children.values():
+            child = self._game_tree.get(child_key)
+            if child is not None and child.expectation() < 1:
+                unsearched_expectation = min(unsearched_expectation, 1 - child.expectation())
 
         for move in move_lst:
             child_key = node.children.get(move, None)
             if child_key is None:
-                cur_expectation = node.expectation()
-                if cur_expectation > best_expectation:
+                cur_rank = self._move_rank(unsearched_expectation, 0)
+                if cur_rank > best_rank:
                     best_move = move
-                    best_expectation = cur_expectation
+                    best_rank = cur_rank
                     best_eval = node.pawn_advantage()
             else:
-                # Remember to do 1 - W b/c win rate of W for opp means win rate of 1 - W for us
-                cur_expectation = 1 - self._game_tree.get(child_key).expectation()
-                if cur_expectation > best_expectation:
+                # Remember to do 1 - W b/c win rate of W for opp means win rate of 1 - W for us.
+                # Ties with an unsearched move go to the searched one
+                child = self._game_tree.get(child_key)
+                cur_expectation = 1 - child.expectation()
+                cur_rank = self._move_rank(cur_expectation, self._rank_visits(child))
+                if cur_rank > best_rank or (cur_rank == best_rank and best_move not in node.children):
                     best_move = move
-                    best_expectation = cur_expectation
+                    best_rank = cur_rank
                     # remember to negate as bad position for opp is good for us
-                    best_eval = -(self._game_tree.get(child_key)).pawn_advantage()
+                    best_eval = -child.pawn_advantage()
 
         perspective = 1 if hash_board.turn() else -1
 
         return best_move, perspective * best_eval
+
+    @staticmethod
+    def _rank_visits(child: TreeNode) -> float:
+        # Visits ranking a searched root move. A determined child's parameters come from its known result (a leaf's
+        # are set to thousands of visits), so they count as none: a drawn move must not outrank searched ones
+        return 0 if child.outcome_score is not None else child.visits()
+
+    def _move_rank(self, expectation: float, visits: float) -> tuple:
+        # Sort key of root moves, higher is better. Thompson sampling plays the best expectation. PUCT plays the most
+        # visited move, as moves it only tried a few times have noisy win rates; but known wins come first and known
+        # losses last, since determined moves are not selected again
+        if self._selection_mode == SelectionMode.PUCT:
+            return expectation == 1, expectation > 0, visits, expectation
+        return (expectation,)
+
+
+"""
+Worker processes
+"""
+_worker_lock = None  # allocation lock of the shared tree, handed to tree-parallel workers when the pool starts
+
+
+def _set_worker_lock(lock):
+    global _worker_lock
+    _worker_lock = lock
+
+
+def _root_parallel_worker(args):
+    """
+    Entry point of a root-parallel worker process. Builds its own tree from the root position.
+    Returns (worker id, positions searched, simulations, stop reason value, root child stats)
+    """
+    worker_id, board, config, num_sim, time_limit, seed = args
+    deadline = None if time_limit is None else default_timer() + time_limit
+    bot = MonteCarloBot(name=f"root_parallel_worker_{worker_id}", seed=seed, **config)
+    hash_board = HashBoard(board, hasher=bot._zobrist_hasher, pawn_table=bot._pawn_table, nnue=bot._nnue,
+                           use_activity=bot._use_activity)
+    stop_reason = bot.run_mtcs(hash_board, hash_board.get_position_hash(), num_sim, deadline)
+    return worker_id, bot._num_pos_searched, bot._num_sims, stop_reason.value, bot.get_root_child_stats(hash_board)
+
+
+def _tree_parallel_worker(args):
+    """
+    Entry point of a tree-parallel worker process. Attaches to the shared tree and runs its simulations on it,
+    with virtual loss. Returns (worker id, positions searched, simulations, stop reason value)
+    """
+    worker_id, board, hasher, tree_name, tree_capacity, num_workers, config, num_sim, time_limit, seed = args
+    deadline = None if time_limit is None else default_timer() + time_limit
+    root_key = hasher.compute_hash(board)
+    game_tree = ArrayHashTree.attach_shared(hasher, tree_name, tree_capacity, virtual_loss_rows=num_workers,
+                                            lock=_worker_lock, worker_slot=worker_id, root_key=root_key,
+                                            batch_size=config["batch_size"])
+    bot = MonteCarloBot(name=f"tree_parallel_worker_{worker_id}", seed=seed, use_virtual_loss=True, hasher=hasher,
+                        game_tree=game_tree, **config)
+    hash_board = HashBoard(board, hasher=hasher, pawn_table=bot._pawn_table, nnue=bot._nnue,
+                           use_activity=bot._use_activity)
+    stop_reason = bot.run_mtcs(hash_board, root_key, num_sim, deadline)
+    game_tree.close()
+    return worker_id, bot._num_pos_searched, bot._num_sims, stop_reason.value
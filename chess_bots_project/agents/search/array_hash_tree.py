@@ -0,0 +1,621 @@
+"""
+Struct-of-arrays backend for the Monte Carlo search tree
+Drop-in alternative to HashTree. Nodes are rows of preallocated NumPy arrays instead of Python objects:
+    node arrays : key, alpha / beta (param), ply, outcome, the range [edge_start, edge_start + edge_count)
+                  of the node's children in the edge arrays (edge_count is -1 until the node is expanded),
+                  and the best searched child with its win rate (TreeNode.best_child_index / best_child_win_rate)
+    edge arrays : child key, encoded move, child's beta parameters from the parent's side, child state,
+                  whether the child was searched from this parent (the 'children' of TreeNode), and move prior
+Keys are mapped to node indices with an open-addressing (linear probing) table.
+The arrays can be placed in a multiprocessing.shared_memory block, so worker processes search one tree.
+get() returns an ArrayTreeNode, a thin view with the TreeNode API, so MonteCarloBot works with either backend.
+Views hold an index: they become invalid after reroot() or evict(), which compact the arrays.
+"""
+
+
+import chess
+import numpy as np
+import weakref
+from collections.abc import MutableMapping
+from contextlib import nullcontext
+
+from agents.search import shared_block
+from agents.search.zobrist_hash import ZobristHash
+from agents.search.hash_tree import TreeNode
+
+
+NODE_FIELDS = (("keys", np.uint64), ("alpha", np.float64), ("beta", np.float64), ("ply", np.int32),
+               ("outcome", np.float32), ("edge_start", np.int64), ("edge_count", np.int32),
+               ("best_child", np.int32), ("best_win_rate", np.float64))
+EDGE_FIELDS = (("edge_key", np.uint64), ("edge_move", np.uint16), ("edge_alpha", np.float32),
+               ("edge_beta", np.float32), ("edge_state", np.int8), ("edge_searched", np.bool_),
+               ("edge_prior", np.float32))
+
+NOT_EXPANDED = -1  # edge_count of a node whose moves are not generated yet
+EMPTY_SLOT = -1
+
+
+def encode_move(move: chess.Move) -> int:
+    # from square (6 bits), to square (6 bits), promotion piece type (3 bits)
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def decode_move(encoded: int) -> chess.Move:
+    return chess.Move(encoded & 0x3F, (encoded >> 6) & 0x3F, (encoded >> 12) or None)
+
+
+class ArrayTreeNode(TreeNode):
+    """
+    View of one node of an ArrayHashTree. Reads and writes go straight to the tree's arrays, so
+    inherited TreeNode methods (parameter updates, Thompson sampling of children, ...) work unchanged
+    """
+    def __init__(self, tree, index: int):
+        # TreeNode.__init__ is not called: all node state lives in the tree's arrays
+        self._tree = tree
+        self._index = index
+
+    @property
+    def _key(self):
+        return int(self._tree.keys[self._index])
+
+    @property
+    def param(self):
+        return float(self._tree.alpha[self._index]), float(self._tree.beta[self._index])
+
+    @param.setter
+    def param(self, value):
+        self._tree.alpha[self._index], self._tree.beta[self._index] = value
+
+    @property
+    def ply(self):
+        return int(self._tree.ply[self._index])
+
+    @ply.setter
+    def ply(self, value):
+        self._tree.ply[self._index] = value
+
+    @property
+    def outcome_score(self):
+        outcome = self._tree.outcome[self._index]
+        return None if np.isnan(outcome) else float(outcome)
+
+    @outcome_score.setter
+    def outcome_score(self, value):
+        self._tree.outcome[self._index] = np.nan if value is None else value
+
+    @property
+    def best_child_index(self):
+        return int(self._tree.best_child[self._index])
+
+    @best_child_index.setter
+    def best_child_index(self, value):
+        self._tree.best_child[self._index] = value
+
+    @property
+    def best_child_win_rate(self):
+        return float(self._tree.best_win_rate[self._index])
+
+    @best_child_win_rate.setter
+    def best_child_win_rate(self, value):
+        self._tree.best_win_rate[self._index] = value
+
+    """
+    Children
+    """
+    def _edge_range(self) -> slice:
+        start = self._tree.edge_start[self._index]
+        return slice(start, start + max(self._tree.edge_count[self._index], 0))
+
+    def is_expanded(self) -> bool:
+        return self._tree.edge_count[self._index] != NOT_EXPANDED
+
+    def expand(self, moves: list, child_keys: list, children: list, priors: np.ndarray | None = None):
+        self._tree.allocate_edges(self._index, [encode_move(move) for move in moves], child_keys, priors)
+        for index, child in enumerate(children):
+            if child is not None:
+                self.update_child(index, child)
+
+    @property
+    def moves(self):
+        if not self.is_expanded():
+            return None
+        return [decode_move(encoded) for encoded in self._tree.edge_move[self._edge_range()].tolist()]
+
+    @property
+    def child_keys(self):
+        if not self.is_expanded():
+            return None
+        return self._tree.edge_key[self._edge_range()].tolist()
+
+    def move_at(self, index: int) -> chess.Move:
+        return decode_move(int(self._tree.edge_move[self._tree.edge_start[self._index] + index]))
+
+    def child_key_at(self, index: int) -> int:
+        return int(self._tree.edge_key[self._tree.edge_start[self._index] + index])
+
+    def add_child(self, index: int):
+        self._tree.edge_searched[self._tree.edge_start[self._index] + index] = True
+
+    def searched_indices(self) -> list:
+        return np.flatnonzero(self._tree.edge_searched[self._edge_range()]).tolist()
+
+    @property
+    def child_alpha(self):
+        return self._tree.edge_alpha[self._edge_range()] if self.is_expanded() else None
+
+    @property
+    def child_beta(self):
+        return self._tree.edge_beta[self._edge_range()] if self.is_expanded() else None
+
+    @property
+    def child_state(self):
+        return self._tree.edge_state[self._edge_range()] if self.is_expanded() else None
+
+    @property
+    def child_prior(self):
+        return self._tree.edge_prior[self._edge_range()] if self.is_expanded() else None
+
+    @property
+    def children(self):
+        return _SearchedChildren(self)
+
+    # Same as TreeNode's, but slicing the edge arrays once instead of on every attribute read
+    def update_child(self, index: int, child):
+        tree = self._tree
+        edge = tree.edge_start[self._index] + index
+        alpha, beta = child.param
+        tree.edge_alpha[edge] = beta + 1
+        tree.edge_beta[edge] = alpha + 1
+        tree.edge_state[edge] = self.IN_TREE if child.outcome_score is None else self.DETERMINED
+
+    def add_virtual_loss(self, index: int):
+        self._tree.edge_virtual_loss[self._tree.worker_slot, self._tree.edge_start[self._index] + index] += 1
+
+    def remove_virtual_loss(self, index: int):
+        self._tree.edge_virtual_loss[self._tree.worker_slot, self._tree.edge_start[self._index] + index] -= 1
+
+    def select_child(self, rng: np.random.Generator) -> int:
+        tree = self._tree
+        edges = self._edge_range()
+        child_alpha = tree.edge_alpha[edges]
+        child_beta = tree.edge_beta[edges]
+        child_state = tree.edge_state[edges]
+        unexplored = child_state == self.UNEXPLORED
+        child_alpha[unexplored] = tree.alpha[self._index] + 1
+        child_beta[unexplored] = tree.beta[self._index] + 1
+        if tree.edge_virtual_loss is not None:
+            # every pending virtual loss counts as a simulation through the child that we lost
+            child_beta = child_beta + tree.edge_virtual_loss[:, edges].sum(axis=0)
+        samples = rng.beta(child_alpha, child_beta)
+        samples[child_state == self.DETERMINED] = -1
+        index = int(np.argmax(samples))
+        if samples[index] < 0:
+            index = int(rng.integers(len(samples)))
+        return index
+
+    def select_child_puct(self, rng: np.random.Generator, c_puct: float, width: int) -> int:
+        tree = self._tree
+        start = tree.edge_start[self._index]
+        count = tree.edge_count[self._index]
+        # unlike slicing a node's own arrays, slicing past the last child would reach other nodes' edges
+        edges = slice(start, start + self._eligible_width(tree.edge_state[start:start + count], min(width, count)))
+        virtual_loss = None if tree.edge_virtual_loss is None else tree.edge_virtual_loss[:, edges].sum(axis=0)
+        return self._puct_index(rng, tree.edge_alpha[edges], tree.edge_beta[edges], tree.edge_state[edges],
+                                tree.edge_prior[edges], virtual_loss, c_puct)
+
+
+class _SearchedChildren(MutableMapping):
+    # dict-like view {chess.Move: child key} of the children searched from a node, like TreeNode.children
+    def __init__(self, node: ArrayTreeNode):
+        self._node = node
+
+    def _edge_index(self, move: chess.Move) -> int | None:
+        edges = self._node._edge_range()
+        matches = np.flatnonzero(self._node._tree.edge_move[edges] == encode_move(move))
+        return edges.start + int(matches[0]) if len(matches) else None
+
+    def __getitem__(self, move):
+        edge = self._edge_index(move)
+        if edge is None or not self._node._tree.edge_searched[edge]:
+            raise KeyError(move)
+        return int(self._node._tree.edge_key[edge])
+
+    def __setitem__(self, move, child_key):
+        edge = self._edge_index(move)
+        if edge is None or int(self._node._tree.edge_key[edge]) != child_key:
+            raise KeyError(move)
+        self._node._tree.edge_searched[edge] = True
+
+    def __delitem__(self, move):
+        edge = self._edge_index(move)
+        if edge is None or not self._node._tree.edge_searched[edge]:
+            raise KeyError(move)
+        self._node._tree.edge_searched[edge] = False
+
+    def _searched_edges(self):
+        edges = self._node._edge_range()
+        return edges.start + np.flatnonzero(self._node._tree.edge_searched[edges])
+
+    def __iter__(self):
+        return (decode_move(encoded) for encoded in self._node._tree.edge_move[self._searched_edges()].tolist())
+
+    def __len__(self):
+        return len(self._searched_edges())
+
+    def items(self):
+        searched = self._searched_edges()
+        tree = self._node._tree
+        return [(decode_move(encoded), key)
+                for encoded, key in zip(tree.edge_move[searched].tolist(), tree.edge_key[searched].tolist())]
+
+
+class ArrayHashTree:
+    """
+    Same interface as HashTree (add, get, size, reroot, is_full, evict). Arrays start at initial_nodes rows
+    (and EDGES_PER_NODE edges per row), and double whenever full.
+    A tree made by create_shared lives in one shared memory block of fixed capacity, so several processes can
+    search it at once (see MonteCarloBot's tree-parallel mode). Only allocation of nodes and edges takes the lock;
+    statistics are updated without it, so an update racing with another process may be lost.
+
+    Attributes
+    keys, alpha, beta, ply, outcome, edge_start, edge_count : node arrays, see module docstring
+    edge_key, edge_move, edge_alpha, edge_beta, edge_state, edge_searched : edge arrays
+    edge_virtual_loss : virtual losses on each edge, one row per process (None if virtual_loss_rows is 0)
+    worker_slot       : row of edge_virtual_loss this process writes to
+    """
+    DEFAULT_INITIAL_NODES = 1 << 14
+    EDGES_PER_NODE = 8  # initial edge capacity per node; only expanded nodes (a minority) have edges
+    EVICT_FRACTION = 0.1
+    EXPANSION_ROOM = 256  # edges one simulation may allocate: the legal moves of the node it expands (218 at most)
+
+    def __init__(self, hasher: ZobristHash, max_nodes=None, initial_nodes=DEFAULT_INITIAL_NODES,
+                 virtual_loss_rows=0, buffer=None, lock=None, worker_slot=0, attach=False, reserved_edges=0):
+        """
+        hasher (ZobristHash)    : used to compute hashes
+        max_nodes (int)         : cap on the number of nodes, see evict(). None for no cap
+        initial_nodes (int)     : initial node capacity. For a tree in a buffer, the fixed capacity
+        virtual_loss_rows (int) : number of processes keeping virtual losses on the tree. 0 to disable virtual loss
+        reserved_edges (int)    : edge capacity on top of EDGES_PER_NODE per node, kept free by has_room()
+        buffer                  : writable buffer to store the arrays in (see create_shared). Arrays are private
+                                  and growable if None
+        lock                    : multiprocessing lock taken when allocating, for a tree shared between processes
+        attach (bool)           : buffer already holds a tree (built by another process), keep it as it is
+        """
+        self._hasher = hasher
+        self.cur_root_key = int
+        self.max_nodes = max_nodes
+        self.worker_slot = worker_slot
+        self._lock = lock
+        self._shared_memory = None
+        self._virtual_loss_rows = virtual_loss_rows
+        self._node_capacity = initial_nodes if max_nodes is None else min(initial_nodes, max_nodes + 1)
+        self._reserved_edges = reserved_edges
+        layout, _ = self._layout(self._node_capacity, virtual_loss_rows, reserved_edges)
+        offset = 0
+        for name, dtype, shape in layout:
+            if buffer is None:
+                array = np.zeros(shape, dtype=dtype)
+            else:
+                array = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+                offset += array.nbytes
+            setattr(self, name, array)
+        self._fixed_capacity = buffer is not None
+        if virtual_loss_rows == 0:
+            self.edge_virtual_loss = None
+        # node and edge counts are arrays too, so they are shared along with the tree
+        self._count_view = memoryview(self._counts)
+        if attach:
+            self._set_index_views()
+        else:
+            self._build_index()
+
+    @classmethod
+    def _layout(cls, node_capacity, virtual_loss_rows, reserved_edges=0) -> (list, int):
+        # (name, dtype, shape) of every array, and total bytes (each array padded to 8 bytes)
+        edge_capacity = node_capacity * cls.EDGES_PER_NODE + reserved_edges
+        num_slots = 1 << (2 * node_capacity - 1).bit_length()
+        layout = [("_counts", np.int64, (2,)), ("_slots", np.int64, (num_slots,))]
+        layout += [(name, dtype, (node_capacity,)) for name, dtype in NODE_FIELDS]
+        layout += [(name, dtype, (edge_capacity,)) for name, dtype in EDGE_FIELDS]
+        if virtual_loss_rows:
+            layout.append(("edge_virtual_loss", np.int16, (virtual_loss_rows, edge_capacity)))
+        padded = []
+        for name, dtype, shape in layout:
+            num_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            # pad small arrays out to 8 bytes so the next one is aligned
+            padded.append((name, dtype, shape))
+            if num_bytes % 8:
+                padded.append((name + "_pad", np.uint8, (8 - num_bytes % 8,)))
+        total = sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, dtype, shape in padded)
+        return padded, total
+
+    @classmethod
+    def create_shared(cls, hasher: ZobristHash, num_nodes: int, virtual_loss_rows=1, lock=None, batch_size=1):
+        """
+        Creates a tree of fixed capacity num_nodes in a new shared memory block. Other processes attach to it
+        with attach_shared(name). The block is unlinked when this tree is garbage collected, or on close().
+        Each of the virtual_loss_rows processes runs batch_size simulations at a time: on top of EDGES_PER_NODE
+        edges per node, the tree gets the edges those may allocate, so a tree with few nodes is not full from the start
+        """
+        reserved_edges = cls._reserved_edges_for(virtual_loss_rows, batch_size)
+        _, num_bytes = cls._layout(num_nodes, virtual_loss_rows, reserved_edges)
+        shm = shared_block.create(num_bytes)
+        tree = cls(hasher, initial_nodes=num_nodes, virtual_loss_rows=virtual_loss_rows, buffer=shm.buf, lock=lock,
+                   reserved_edges=reserved_edges)
+        tree._finalizer = weakref.finalize(tree, shared_block.unlink, shm.name)
+        # set after the arrays, so they are released before the block when the tree is garbage collected
+        tree._shared_memory = shm
+        return tree
+
+    @classmethod
+    def attach_shared(cls, hasher: ZobristHash, name: str, num_nodes: int, virtual_loss_rows=1, lock=None,
+                      worker_slot=0, root_key=int, batch_size=1):
+        """
+        Attaches to a tree created by create_shared in another process, with the same num_nodes,
+        virtual_loss_rows and batch_size. Hasher must hash positions the same way as the creator's
+        """
+        shm = shared_block.attach(name)
+        tree = cls(hasher, initial_nodes=num_nodes, virtual_loss_rows=virtual_loss_rows, buffer=shm.buf,
+                   lock=lock, worker_slot=worker_slot, attach=True,
+                   reserved_edges=cls._reserved_edges_for(virtual_loss_rows, batch_size))
+        tree.cur_root_key = root_key
+        tree._finalizer = None
+        tree._shared_memory = shm
+        return tree
+
+    def close(self):
+        """
+        Releases the shared memory block, and unlinks it if this tree created it. The tree is unusable afterwards.
+        The arrays are views of the block, so they are dropped first
+        """
+        if self._shared_memory is None:
+            return
+        shm = self._shared_memory
+        self._shared_memory = None
+        views = (self._count_view, self._slot_view, self._key_view)
+        for name, value in list(vars(self).items()):
+            if isinstance(value, (np.ndarray, memoryview)):
+                setattr(self, name, None)
+        shared_block.release(shm, views)
+        if self._finalizer is not None:
+            self._finalizer()
+
+    def shared_memory_name(self) -> str | None:
+        return None if self._shared_memory is None else self._shared_memory.name
+
+    def capacity(self) -> int:
+        return self._node_capacity
+
+    @property
+    def _num_nodes(self):
+        return self._count_view[0]
+
+    @_num_nodes.setter
+    def _num_nodes(self, value):
+        self._count_view[0] = value
+
+    @property
+    def _num_edges(self):
+        return self._count_view[1]
+
+    @_num_edges.setter
+    def _num_edges(self, value):
+        self._count_view[1] = value
+
+    def add(self, hash_key: int, ply_cnt: int):
+        # right now, we automatically replace entry when hash collision occurs.
+        # In a shared tree, a position added by another process in the meantime is kept as it is
+        with self._allocation_lock():
+            index = self._find(hash_key)
+            if index is None:
+                if self._num_nodes == len(self.keys):
+                    self._grow_nodes()
+                index = self._num_nodes
+                self._num_nodes += 1
+            elif self._lock is not None:
+                return
+            self.keys[index] = hash_key
+            self.alpha[index] = 1.0
+            self.beta[index] = 1.0
+            self.ply[index] = ply_cnt
+            self.outcome[index] = np.nan
+            self.edge_start[index] = 0
+            self.edge_count[index] = NOT_EXPANDED
+            self.best_child[index] = TreeNode.NO_BEST_CHILD
+            self.best_win_rate[index] = -np.inf
+            # published last, so other processes never find a half-written node
+            self._insert(hash_key, index)
+
+    def get(self, hash_key: int) -> ArrayTreeNode | None:
+        index = self._find(hash_key)
+        return None if index is None else ArrayTreeNode(self, index)
+
+    def size(self):
+        return self._num_nodes
+
+    def num_edges(self):
+        return self._num_edges
+
+    def nbytes(self) -> int:
+        # memory held by the arrays (including unused capacity)
+        return self._layout(len(self.keys), self._virtual_loss_rows, self._reserved_edges)[1]
+
+    @classmethod
+    def _reserved_edges_for(cls, virtual_loss_rows, batch_size) -> int:
+        return cls.EXPANSION_ROOM * batch_size * max(virtual_loss_rows, 1)
+
+    def has_room(self, batch_size=1) -> bool:
+        """
+        Whether a batch of batch_size simulations can run without running out of space, while every other process
+        searching the tree runs one too: each simulation adds at most one node, and expands one node in general.
+        Only a shared tree can run out
+        """
+        if not self._fixed_capacity:
+            return True
+        num_simulations = batch_size * max(self._virtual_loss_rows, 1)
+        return (self._num_nodes + num_simulations <= len(self.keys)
+                and self._num_edges + self.EXPANSION_ROOM * num_simulations <= len(self.edge_key))
+
+    def allocate_edges(self, index: int, encoded_moves: list, child_keys: list, priors: np.ndarray | None = None):
+        # Appends the children of node index to the edge arrays, all unexplored. Priors are 0 if not given
+        num_moves = len(encoded_moves)
+        with self._allocation_lock():
+            if self._lock is not None and self.edge_count[index] != NOT_EXPANDED:
+                return  # another process expanded the node first
+            while self._num_edges + num_moves > len(self.edge_key):
+                self._grow_edges()
+            start = self._num_edges
+            end = start + num_moves
+            self.edge_key[start:end] = child_keys
+            self.edge_move[start:end] = encoded_moves
+            self.edge_alpha[start:end] = 1.0
+            self.edge_beta[start:end] = 1.0
+            self.edge_state[start:end] = TreeNode.UNEXPLORED
+            self.edge_searched[start:end] = False
+            self.edge_prior[start:end] = 0.0 if priors is None else priors
+            if self.edge_virtual_loss is not None:
+                self.edge_virtual_loss[:, start:end] = 0
+            self._num_edges = end
+            self.edge_start[index] = start
+            self.edge_count[index] = num_moves
+
+    def _allocation_lock(self):
+        return nullcontext() if self._lock is None else self._lock
+
+    """
+    Garbage collection
+    Never while another process is searching a shared tree
+    """
+    def reroot(self, root_key: int) -> int:
+        """
+        Makes root_key the root, and drops every node that can no longer be reached from it.
+        Returns number of nodes dropped
+        """
+        self.cur_root_key = root_key
+        root = self._find(root_key)
+        keep = np.zeros(self._num_nodes, dtype=np.bool_)
+        if root is not None:
+            keep[root] = True
+            frontier = [root]
+            while frontier:
+                next_frontier = []
+                for index in frontier:
+                    start = self.edge_start[index]
+                    for child_key in self.edge_key[start:start + max(self.edge_count[index], 0)].tolist():
+                        child = self._find(child_key)
+                        if child is not None and not keep[child]:
+                            keep[child] = True
+                            next_frontier.append(child)
+                frontier = next_frontier
+        return self._compact(keep)
+
+    def is_full(self) -> bool:
+        return self.max_nodes is not None and self._num_nodes > self.max_nodes
+
+    def evict(self, target_size=None) -> int:
+        """
+        Drops least visited nodes (deepest first on ties) until the tree has target_size nodes, by default
+        max_nodes less EVICT_FRACTION of it. The root is never dropped. Returns number of nodes dropped
+        """
+        if target_size is None:
+            target_size = self.max_nodes - int(self.max_nodes * self.EVICT_FRACTION)
+        num_evict = self._num_nodes - max(target_size, 1)
+        if num_evict <= 0:
+            return 0
+        visits = self.alpha[:self._num_nodes] + self.beta[:self._num_nodes] - 2
+        root = self._find(self.cur_root_key) if isinstance(self.cur_root_key, int) else None
+        if root is not None:
+            visits[root] = np.inf
+        # lexsort sorts by the last key first: visits, then deeper plies first
+        order = np.lexsort((-self.ply[:self._num_nodes], visits))
+        keep = np.ones(self._num_nodes, dtype=np.bool_)
+        keep[order[:num_evict]] = False
+        return self._compact(keep)
+
+    def _compact(self, keep: np.ndarray) -> int:
+        # Moves the kept nodes (and their edges) to the front of the arrays, in order. Returns number dropped
+        kept = np.flatnonzero(keep)
+        num_kept = len(kept)
+        num_dropped = self._num_nodes - num_kept
+        if num_dropped == 0:
+            return 0
+        for name, _ in NODE_FIELDS:
+            array = getattr(self, name)
+            array[:num_kept] = array[kept]
+
+        counts = np.maximum(self.edge_count[:num_kept], 0).astype(np.int64)
+        new_starts = np.cumsum(counts) - counts
+        num_edges = int(counts.sum())
+        # index of each kept edge in the old arrays
+        gather = np.repeat(self.edge_start[:num_kept] - new_starts, counts) + np.arange(num_edges)
+        for name, _ in EDGE_FIELDS:
+            array = getattr(self, name)
+            array[:num_edges] = array[gather]
+        if self.edge_virtual_loss is not None:
+            # no simulation is running, so there is no virtual loss to keep
+            self.edge_virtual_loss[:, :num_edges] = 0
+        self.edge_start[:num_kept] = new_starts
+        self._num_nodes = num_kept
+        self._num_edges = num_edges
+        # children that were dropped are no longer 'searched'. Their sampling parameters are kept.
+        # Parents that lost a searched child look for their best child again
+        still_searched = np.isin(self.edge_key[:num_edges], self.keys[:num_kept])
+        lost_child = self.edge_searched[:num_edges] & ~still_searched
+        self.best_child[np.repeat(np.arange(num_kept), counts)[lost_child]] = TreeNode.NO_BEST_CHILD
+        self.edge_searched[:num_edges] &= still_searched
+        self._build_index()
+        return num_dropped
+
+    """
+    Open addressing index
+    """
+    def _build_index(self):
+        # table at most half full, so probe sequences stay short
+        num_slots = 1 << (2 * len(self.keys) - 1).bit_length()
+        if len(self._slots) == num_slots:
+            self._slots.fill(EMPTY_SLOT)  # in place: a shared table stays shared
+        else:
+            self._slots = np.full(num_slots, EMPTY_SLOT, dtype=np.int64)
+        self._set_index_views()
+        for index, key in enumerate(self.keys[:self._num_nodes].tolist()):
+            self._insert(key, index)
+
+    def _set_index_views(self):
+        self._slot_mask = len(self._slots) - 1
+        self._slot_view = memoryview(self._slots)
+        self._key_view = memoryview(self.keys)
+
+    def _find(self, hash_key: int) -> int | None:
+        slot = hash_key & self._slot_mask
+        index = self._slot_view[slot]
+        while index != EMPTY_SLOT:
+            if self._key_view[index] == hash_key:
+                return index
+            slot = (slot + 1) & self._slot_mask
+            index = self._slot_view[slot]
+        return None
+
+    def _insert(self, hash_key: int, index: int):
+        slot = hash_key & self._slot_mask
+        while self._slot_view[slot] != EMPTY_SLOT:
+            slot = (slot + 1) & self._slot_mask
+        self._slot_view[slot] = index
+
+    def _grow_nodes(self):
+        if self._fixed_capacity:
+            raise RuntimeError("Shared tree is full. Check has_room() before each simulation!")
+        for name, _ in NODE_FIELDS:
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate((array, np.zeros_like(array))))
+        self._node_capacity = len(self.keys)
+        self._build_index()
+
+    def _grow_edges(self):
+        if self._fixed_capacity:
+            raise RuntimeError("Shared tree is full. Check has_room() before each simulation!")
+        for name, _ in EDGE_FIELDS:
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate((array, np.zeros_like(array))))
+        if self.edge_virtual_loss is not None:
+            self.edge_virtual_loss = np.concatenate((self.edge_virtual_loss, np.zeros_like(self.edge_virtual_loss)),
+                                                    axis=1)
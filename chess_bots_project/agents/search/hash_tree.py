@@ -6,8 +6,9 @@ Stores search tree for monte carlo
 
 import chess
 import numpy as np
-from scipy.stats import beta
 import enum
+import heapq
+from collections import deque
 
 from agents.search.zobrist_hash import ZobristHash
 from agents.evaluation import eval_func
@@ -15,6 +16,11 @@ from agents.evaluation import eval_func
 
 class TreeNode:
     LN_10 = np.log(10)
+    # states of a child in child_state
+    UNEXPLORED = 0  # not in the tree yet; sampled from this node's own distribution
+    IN_TREE = 1  # in the tree; sampled from the child's distribution, seen from this node's side
+    DETERMINED = 2  # result known for certain (outcome_score is set); never selected
+    NO_BEST_CHILD = -1  # best_child_index when the best searched child must be found again by a full scan
 
     def __init__(self, key, ply):
         self._key = key
@@ -25,6 +31,128 @@ class TreeNode:
         # any node with node forced draw or checkmate is a determined state
         # including terminal states like checkmates or stalemates
         self.outcome_score = None
+        # Legal moves and the hash keys of the positions they lead to. Filled the first time the node is expanded,
+        # so later selections don't need to make / unmake every move
+        self.moves = None
+        self.child_keys = None
+        # Beta parameters (with laplace smoothing) of each child's win rate from THIS node's player's perspective,
+        # in contiguous arrays so all children are sampled in one call. A child's entry is refreshed whenever
+        # a simulation passes through it from this node
+        self.child_alpha = None
+        self.child_beta = None
+        self.child_state = None
+        # Prior probability of each move (PUCT selection only; moves are then sorted by decreasing prior)
+        self.child_prior = None
+        # Virtual losses of simulations in flight through each child, allocated on first use
+        self.child_virtual_loss = None
+        # Searched child with the highest win rate from this node's perspective, and that win rate,
+        # kept up to date during back-propagation so it doesn't need to look at every child
+        self.best_child_index = self.NO_BEST_CHILD
+        self.best_child_win_rate = -np.inf
+
+    def is_expanded(self) -> bool:
+        return self.moves is not None
+
+    def expand(self, moves: list, child_keys: list, children: list, priors: np.ndarray | None = None):
+        """
+        children: for each move, the TreeNode it leads to, or None if it is not in the tree yet
+        priors  : for each move, its prior probability. Needed for select_child_puct only
+        """
+        self.moves = moves
+        self.child_keys = child_keys
+        self.child_alpha = np.ones(len(moves))
+        self.child_beta = np.ones(len(moves))
+        self.child_state = np.full(len(moves), self.UNEXPLORED, dtype=np.int8)
+        self.child_prior = priors
+        for index, child in enumerate(children):
+            if child is not None:
+                self.update_child(index, child)
+
+    def move_at(self, index: int) -> chess.Move:
+        return self.moves[index]
+
+    def child_key_at(self, index: int) -> int:
+        return self.child_keys[index]
+
+    def add_child(self, index: int):
+        # records that the position after moves[index] has been searched from this node
+        self.children[self.moves[index]] = self.child_keys[index]
+
+    def searched_indices(self) -> list:
+        # indices of the children searched from this node, i.e. the moves in children
+        return [index for index, move in enumerate(self.moves) if move in self.children]
+
+    def update_child(self, index: int, child):
+        # we take advantage of the fact that beta(a, b) = 1 - beta(b, a): swap parameters to get our perspective
+        self.child_alpha[index] = child.param[1] + 1
+        self.child_beta[index] = child.param[0] + 1
+        self.child_state[index] = self.IN_TREE if child.outcome_score is None else self.DETERMINED
+
+    def add_virtual_loss(self, index: int):
+        # counts a simulation in flight through the child as a loss until it is back-propagated,
+        # so other simulations running at the same time are steered elsewhere
+        if self.child_virtual_loss is None:
+            self.child_virtual_loss = np.zeros(len(self.moves), dtype=np.int32)
+        self.child_virtual_loss[index] += 1
+
+    def remove_virtual_loss(self, index: int):
+        self.child_virtual_loss[index] -= 1
+
+    def select_child(self, rng: np.random.Generator) -> int:
+        """
+        Thompson sampling over all children in one vectorized draw. Returns index of the chosen move,
+        or a random index if every child is determined
+        """
+        unexplored = self.child_state == self.UNEXPLORED
+        self.child_alpha[unexplored] = self.param[0] + 1
+        self.child_beta[unexplored] = self.param[1] + 1
+        child_beta = self.child_beta
+        if self.child_virtual_loss is not None:
+            child_beta = child_beta + self.child_virtual_loss
+        samples = rng.beta(self.child_alpha, child_beta)
+        samples[self.child_state == self.DETERMINED] = -1
+        index = int(np.argmax(samples))
+        if samples[index] < 0:
+            index = int(rng.integers(len(self.moves)))
+        return index
+
+    def select_child_puct(self, rng: np.random.Generator, c_puct: float, width: int) -> int:
+        """
+        PUCT selection among the first width children (progressive widening; moves are sorted by decreasing prior).
+        Picks the child maximizing Q + c_puct * P * sqrt(N) / (1 + n): Q is the child's win rate from our perspective
+        (this node's own for unexplored children), P its prior, N this node's visits and n the child's.
+        Returns index of the chosen move, or a random index if every child is determined
+        """
+        width = self._eligible_width(self.child_state, width)
+        virtual_loss = None if self.child_virtual_loss is None else self.child_virtual_loss[:width]
+        return self._puct_index(rng, self.child_alpha[:width], self.child_beta[:width], self.child_state[:width],
+                                self.child_prior[:width], virtual_loss, c_puct)
+
+    def _eligible_width(self, child_state: np.ndarray, width: int) -> int:
+        # Progressive widening width, extended to the next move (by prior) not determined yet when every move within
+        # width is determined, so simulations aren't spent on solved moves until the node has enough visits
+        if width < len(child_state) and (child_state[:width] == self.DETERMINED).all():
+            undetermined = np.flatnonzero(child_state[width:] != self.DETERMINED)
+            if len(undetermined):
+                width += int(undetermined[0]) + 1
+        return width
+
+    def _puct_index(self, rng, child_alpha, child_beta, child_state, child_prior, virtual_loss, c_puct) -> int:
+        # child_alpha / child_beta are the child's parameters from our side, plus one
+        explored = child_state != self.UNEXPLORED
+        child_visits = np.where(explored, child_alpha + child_beta - 4, 0.0)
+        child_wins = np.where(explored, child_alpha - 2, 0.0)
+        if virtual_loss is not None:
+            # simulations in flight count as visits we lost
+            child_visits = child_visits + virtual_loss
+        win_rate = np.divide(child_wins, child_visits, out=np.full(len(child_visits), self.expectation()),
+                             where=child_visits > 0)
+        scores = win_rate + c_puct * child_prior * np.sqrt(max(self.visits(), 1)) / (1 + child_visits)
+        scores[child_state == self.DETERMINED] = -np.inf
+        index = int(np.argmax(scores))
+        if scores[index] == -np.inf:
+            index = int(rng.integers(len(scores)))
+        return index
 
     def update_param_from_score(self, pawn_advantage: float):
         wins = self.win_rate_from_score(pawn_advantage)
@@ -42,6 +170,10 @@ class TreeNode:
             return 0.0001
         return 1/(1 + np.exp(-self.LN_10 * pawn_advantage / 4))
 
+    def visits(self):
+        # every simulation through the node adds one (split between the two parameters) to param
+        return self.param[0] + self.param[1] - 2
+
     def win_rate_from_param(self):
         if self.param[0] + self.param[1] - 2 <= 0:
             return 0.5
@@ -57,11 +189,11 @@ class TreeNode:
             return -eval_func.CHECKMATE_SCORE
         return 4 * np.log10(win_rate / (1 - win_rate))
 
-    def sample(self):
+    def sample(self, rng: np.random.Generator):
         # Returns a sample of the beta with laplace smoothing
         if self.outcome_score is not None:
             return self.outcome_score
-        return beta.rvs(self.param[0] + 1, self.param[1] + 1)
+        return rng.beta(self.param[0] + 1, self.param[1] + 1)
 
     def expectation(self):
         if self.outcome_score is not None:
@@ -70,10 +202,17 @@ class TreeNode:
 
 
 class HashTree:
-    def __init__(self, hasher: ZobristHash):
+    EVICT_FRACTION = 0.1  # share of max_nodes freed each time the tree is over its cap
+
+    def __init__(self, hasher: ZobristHash, max_nodes=None):
+        """
+        hasher (ZobristHash) : used to compute hashes
+        max_nodes (int)      : cap on the number of nodes. None for no cap. See evict()
+        """
         self.tree = dict()
         self._hasher = hasher
         self.cur_root_key = int
+        self.max_nodes = max_nodes
 
     def add(self, hash_key: int, ply_cnt: int):
         # right now, we automatically replace entry when hash collision occurs
@@ -84,3 +223,67 @@ class HashTree:
 
     def size(self):
         return len(self.tree)
+
+    """
+    Garbage collection
+    """
+    def reroot(self, root_key: int) -> int:
+        """
+        Makes root_key the root, and drops every node that can no longer be reached from it
+        (e.g. positions with moves that were not played). Statistics of the reachable subtree are kept.
+        Returns number of nodes dropped
+        """
+        self.cur_root_key = root_key
+        if root_key not in self.tree:
+            num_dropped = len(self.tree)
+            self.tree = dict()
+            return num_dropped
+
+        reachable = {root_key: self.tree[root_key]}
+        queue = deque([reachable[root_key]])
+        while queue:
+            node = queue.popleft()
+            if not node.is_expanded():
+                continue
+            for child_key in node.child_keys:
+                if child_key not in reachable:
+                    child = self.tree.get(child_key)
+                    if child is not None:
+                        reachable[child_key] = child
+                        queue.append(child)
+        num_dropped = len(self.tree) - len(reachable)
+        self.tree = reachable
+        return num_dropped
+
+    def is_full(self) -> bool:
+        return self.max_nodes is not None and len(self.tree) > self.max_nodes
+
+    def has_room(self, batch_size=1) -> bool:
+        # the dict grows as needed, see ArrayHashTree.has_room for trees that can run out of space
+        return True
+
+    def evict(self, target_size=None) -> int:
+        """
+        Drops least visited nodes (deepest first on ties, so leaves go before their ancestors) until
+        the tree has target_size nodes, by default max_nodes less EVICT_FRACTION of it. The root is never dropped.
+        Should be called between simulations, not during one. Returns number of nodes dropped
+        """
+        if target_size is None:
+            target_size = self.max_nodes - int(self.max_nodes * self.EVICT_FRACTION)
+        num_evict = len(self.tree) - max(target_size, 1)
+        if num_evict <= 0:
+            return 0
+
+        candidates = (key for key in self.tree if key != self.cur_root_key)
+        victims = heapq.nsmallest(num_evict, candidates, key=lambda k: (self.tree[k].visits(), -self.tree[k].ply))
+        for key in victims:
+            del self.tree[key]
+        # Parents must not list dropped children. Their sampling arrays may keep the last known statistics
+        # of a dropped child; it is added back to the tree the next time it is selected
+        for node in self.tree.values():
+            if node.children:
+                for move, child_key in list(node.children.items()):
+                    if child_key not in self.tree:
+                        del node.children[move]
+                        node.best_child_index = TreeNode.NO_BEST_CHILD
+        return len(victims)
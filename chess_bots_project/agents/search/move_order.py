@@ -20,6 +20,53 @@ def get_ordered_move_lst(board: chess.Board):
     return move_lst
 
 
+def get_ordered_capture_lst(board: chess.Board):
+    """
+    Returns legal captures (including en passant) and promotions, ordered by MVV-LVA
+    """
+    captures = list(board.generate_legal_captures())
+    # quiet promotions: pawns moving onto an empty back rank square
+    captures.extend(board.generate_legal_moves(board.pawns, chess.BB_BACKRANKS & ~board.occupied))
+    captures.sort(key=lambda capture: mvv_lva_score(board, capture), reverse=True)
+    return captures
+
+
+def staged_move_generator(board: chess.Board, tt_move: chess.Move | None = None, killers=(), history_score=None):
+    """
+    Yields legal moves in stages, generating each stage only once the previous one is exhausted,
+    so a cutoff on an early move saves generating (and scoring) the rest:
+    1. transposition table move (only checked for legality, nothing else is generated)
+    2. captures and promotions, in MVV-LVA order
+    3. killer moves, i.e. quiet moves that caused cutoffs elsewhere at the same ply
+    4. remaining quiet moves, ordered by history_score(move) if given
+    Board must be back in the same position whenever the generator is resumed.
+    """
+    if tt_move is not None and board.is_legal(tt_move):
+        yield tt_move
+
+    for move in get_ordered_capture_lst(board):
+        if move != tt_move:
+            yield move
+
+    searched_killers = []
+    for killer in killers:
+        if killer is None or killer == tt_move or killer in searched_killers:
+            continue
+        if killer.promotion is None and not board.is_capture(killer) and board.is_legal(killer):
+            searched_killers.append(killer)
+            yield killer
+
+    # quiet moves: everything not landing on an opponent piece, except en passant and promotions (already searched).
+    # Mask can't exclude own pieces, as python-chess generates castling as the king moving onto its rook
+    quiets = [move for move in board.generate_legal_moves(chess.BB_ALL, ~board.occupied_co[not board.turn])
+              if move.promotion is None and not board.is_en_passant(move)
+              and move != tt_move and move not in searched_killers]
+    if history_score is not None:
+        quiets.sort(key=history_score, reverse=True)
+    for move in quiets:
+        yield move
+
+
 def simple_score_move(board: chess.Board, move: chess.Move) -> float:
     """
     Calculates a simple score heuristic for moves only looking at captures and promotions
@@ -74,6 +121,23 @@ def score_move(board: chess.Board, move: chess.Move) -> float:
     return score / eval_func.PAWN_ADVANTAGE
 
 
+def mvv_lva_score(board: chess.Board, move: chess.Move) -> int:
+    """
+    Most Valuable Victim - Least Valuable Attacker score for ordering captures and promotions.
+    Unlike simple_score_move, en passant counts as a capture. Returns score in centipawns
+    """
+    score = 0
+    piece_type_moved = board.piece_type_at(move.from_square)
+    captured_type = board.piece_type_at(move.to_square)
+    if captured_type is None and board.is_en_passant(move):
+        captured_type = chess.PAWN
+    if captured_type is not None:
+        score += 10 * eval_func.PIECE_VALUES[captured_type] - eval_func.PIECE_VALUES[piece_type_moved]
+    if move.promotion is not None:
+        score += eval_func.PIECE_VALUES[move.promotion] - eval_func.PIECE_VALUES[chess.PAWN]
+    return score
+
+
 def is_mate_in_one(board: chess.Board, move: chess.Move) -> bool:
     # make move, check if resulting position is checkmate, then unmake move and return result
     board.push(move)
@@ -0,0 +1,109 @@
+"""
+Move ordering statistics learned from beta cutoffs during search
+Killer moves, butterfly history table and counter moves
+"""
+
+
+import chess
+import random
+
+
+class SearchHeuristics:
+    """
+    Tables updated whenever a quiet move causes a beta cutoff. Kept between iterations and moves, and
+    can be shared by several search drivers.
+
+    Attributes
+    killers (list)          : for each ply (distance from root), the last NUM_KILLERS quiet moves that caused a cutoff
+    history (list)          : butterfly table history[color][from_square][to_square], bonus of depth^2 per cutoff
+    counter_moves (list)    : counter_moves[from_square][to_square] of the previous move -> quiet move that refuted it
+    """
+    NUM_KILLERS = 2
+    MAX_HISTORY = 1 << 24  # all history scores are halved once one of them passes this
+
+    def __init__(self, max_ply=128):
+        self._max_ply = max_ply
+        self.killers = [[None] * self.NUM_KILLERS for _ in range(max_ply + 1)]
+        self.history = [[[0] * 64 for _ in range(64)] for _ in chess.COLORS]
+        self.counter_moves = [[None] * 64 for _ in range(64)]
+        self._root_ply = None
+
+    def update_cutoff(self, color: chess.Color, move: chess.Move, ply: int, depth: int,
+                      prev_move: chess.Move | None = None):
+        """
+        Records that quiet move caused a beta cutoff at given ply, with given remaining depth.
+        prev_move is the opponent's move leading to the position (None at the root, or after a null move)
+        """
+        killers = self.killers[ply]
+        if killers[0] != move:
+            # shift older killers down a slot
+            killers[1:] = killers[:-1]
+            killers[0] = move
+
+        color_history = self.history[color]
+        color_history[move.from_square][move.to_square] += depth * depth
+        if color_history[move.from_square][move.to_square] > self.MAX_HISTORY:
+            self.age_history()
+
+        if prev_move:
+            self.counter_moves[prev_move.from_square][prev_move.to_square] = move
+
+    def get_killers(self, ply: int, prev_move: chess.Move | None = None) -> tuple:
+        """
+        Returns killer moves of the ply, followed by the counter move to prev_move (if any)
+        """
+        if prev_move:
+            return (*self.killers[ply], self.counter_moves[prev_move.from_square][prev_move.to_square])
+        return tuple(self.killers[ply])
+
+    def history_score(self, color: chess.Color, move: chess.Move) -> int:
+        return self.history[color][move.from_square][move.to_square]
+
+    def history_sort_key(self, color: chess.Color):
+        # Returns a function scoring moves of given color by history, for use as a sort key
+        color_history = self.history[color]
+        return lambda move: color_history[move.from_square][move.to_square]
+
+    def copy_from(self, other: "SearchHeuristics"):
+        # Takes over the tables of other (e.g. returned by a search in another process), keeping this object,
+        # so bots sharing it see the new tables too
+        self._max_ply = other._max_ply
+        self.killers = [list(killers) for killers in other.killers]
+        self.history = [[list(from_history) for from_history in color_history] for color_history in other.history]
+        self.counter_moves = [list(to_moves) for to_moves in other.counter_moves]
+        self._root_ply = other._root_ply
+
+    """
+    Aging
+    """
+    def age_history(self, divisor=2):
+        for color_history in self.history:
+            for from_history in color_history:
+                for to_square in range(64):
+                    from_history[to_square] //= divisor
+
+    def perturb_history(self, seed: int, max_bonus=16):
+        # Adds small random scores to the history table, so searches sharing work (e.g. lazy SMP helpers)
+        # order their quiet moves differently
+        rng = random.Random(seed)
+        for color_history in self.history:
+            for from_history in color_history:
+                for to_square in range(64):
+                    from_history[to_square] += rng.randrange(max_bonus)
+
+    def new_iteration(self):
+        # Deeper iterations give bigger bonuses anyway; shrink what the shallower iterations learned
+        self.age_history()
+
+    def new_search(self, root_ply: int):
+        """
+        Call before searching a new root position. Killers are shifted by the number of plies played since
+        the last search, so they stay at the same distance from the start of the game
+        """
+        if self._root_ply is not None and 0 < root_ply - self._root_ply <= self._max_ply:
+            shift = root_ply - self._root_ply
+            self.killers = self.killers[shift:] + [[None] * self.NUM_KILLERS for _ in range(shift)]
+        else:
+            self.killers = [[None] * self.NUM_KILLERS for _ in range(self._max_ply + 1)]
+        self._root_ply = root_ply
+        self.age_history()
@@ -0,0 +1,35 @@
+"""
+Shared memory blocks holding the tables that several search processes work on (TranspositionTable, ArrayHashTree).
+The creating process owns the block and unlinks it; other processes only attach to it and close it.
+"""
+
+
+from multiprocessing import shared_memory
+
+
+def create(num_bytes: int) -> shared_memory.SharedMemory:
+    return shared_memory.SharedMemory(create=True, size=num_bytes)
+
+
+def attach(name: str) -> shared_memory.SharedMemory:
+    # Processes started by multiprocessing share the creator's resource tracker, so attaching doesn't
+    # register the block a second time
+    return shared_memory.SharedMemory(name=name)
+
+
+def release(shm: shared_memory.SharedMemory, views=(), unlink=False):
+    # Views of the block must be released before it can be closed
+    for view in views:
+        view.release()
+    shm.close()
+    if unlink:
+        shm.unlink()
+
+
+def unlink(name: str):
+    # Unlinks the block called name, unless it is gone already
+    try:
+        shm = attach(name)
+    except FileNotFoundError:
+        return
+    release(shm, unlink=True)
@@ -1,11 +1,24 @@
 """
 Implementation of transposition table
+Fixed-size, preallocated table. Each entry is two 64-bit words in flat arrays:
+    key word  : Zobrist key of the position XOR the data word, used to verify the entry belongs to the probed position
+    data word : packed score, depth, node type (bound), best move and age
+The table can live in a multiprocessing.shared_memory buffer, so several search processes share it without locks.
+Storing key ^ data means an entry torn by two processes writing at once fails verification, instead of
+returning another position's data.
 """
 
 
 import typing
 import chess
 import enum
+import math
+import weakref
+
+import numpy as np
+
+from agents.evaluation.eval_cache import power_of_two_entries
+from agents.search import shared_block
 
 
 class NodeType(enum.Enum):
@@ -15,29 +28,186 @@ class NodeType(enum.Enum):
 
 
 class MinimaxEntry(typing.NamedTuple):
-    # Currently the simplest transposition table possible
     key: int
     score: float
-    # best_move: chess.Move
-    # node_type: NodeType
+    depth: int
+    node_type: NodeType
+    best_move: chess.Move | None
     age: int
 
 
 class TranspositionTable:
-    def __init__(self, hasher):
-        self.table = dict()
-        self._hasher = hasher  # hasher is a Zobrist hash object. used to compute hashes
+    ENTRY_BYTES = 16  # one key word and one data word
+    DEFAULT_SIZE_MB = 16
+
+    # Layout of the data word (low bit -> high bit)
+    # score: 32 bits, centipawns with an offset so it is stored unsigned
+    # depth: 8 bits, node type: 2 bits (0 = empty slot), best move: 16 bits (0 = no move), age: 6 bits
+    _SCORE_BITS = 32
+    _SCORE_OFFSET = 1 << 31
+    _SCORE_INF = (1 << 31) - 1  # centipawn value used for +/- infinity
+    _SCORE_SCALE = 100  # scores are in pawns, stored in centipawns
+    _DEPTH_SHIFT = 32
+    _TYPE_SHIFT = 40
+    _MOVE_SHIFT = 42
+    _AGE_SHIFT = 58
+    _AGE_MASK = 0x3F
+    _NODE_TYPES = (None, NodeType.PV, NodeType.CUT, NodeType.ALL)
+
+    def __init__(self, hasher, size_mb=DEFAULT_SIZE_MB, buffer=None):
+        """
+        hasher (ZobristHash) : hasher is a Zobrist hash object. used to compute hashes
+        size_mb (float)      : memory budget of the table
+        buffer               : writable buffer to store the table in. A private one is allocated if None.
+                               Use create_shared / attach_shared for a table in shared memory
+        """
+        self._hasher = hasher
+        self._num_entries = self.num_entries_for(size_mb)
+        self._index_mask = self._num_entries - 1
+        table_bytes = self.ENTRY_BYTES * self._num_entries
+        if buffer is None:
+            buffer = bytearray(table_bytes)
+        self._buffer = memoryview(buffer)[:table_bytes]
+        # 'Q' views give us plain Python ints on reads, much cheaper than NumPy scalars in the search loop
+        self._keys = self._buffer[:table_bytes // 2].cast('Q')
+        self._data = self._buffer[table_bytes // 2:].cast('Q')
+        self._age = 0
+        self._num_filled = 0
+        self._shared_memory = None
+
+    @classmethod
+    def num_entries_for(cls, size_mb) -> int:
+        return power_of_two_entries(size_mb, cls.ENTRY_BYTES)
+
+    @classmethod
+    def create_shared(cls, hasher, size_mb=DEFAULT_SIZE_MB):
+        """
+        Creates a table in a new shared memory block. Other processes attach to it with attach_shared(name).
+        The block is unlinked when this table is garbage collected, or when close() is called
+        """
+        shm = shared_block.create(cls.ENTRY_BYTES * cls.num_entries_for(size_mb))
+        table = cls(hasher, size_mb, buffer=shm.buf)
+        table._shared_memory = shm
+        table._finalizer = weakref.finalize(table, shared_block.release, shm, (table._keys, table._data, table._buffer),
+                                            unlink=True)
+        return table
+
+    @classmethod
+    def attach_shared(cls, hasher, name: str, size_mb=DEFAULT_SIZE_MB, age=0):
+        """
+        Attaches to a table created by create_shared in another process. Hasher must hash positions the
+        same way as the creator's, and age should be the creator's current age
+        """
+        shm = shared_block.attach(name)
+        table = cls(hasher, size_mb, buffer=shm.buf)
+        table._shared_memory = shm
+        table._age = age
+        table._finalizer = weakref.finalize(table, shared_block.release, shm, (table._keys, table._data, table._buffer))
+        return table
+
+    def close(self):
+        # Releases the shared memory block (and unlinks it, if this table created it)
+        if self._shared_memory is not None:
+            self._finalizer()
+            self._shared_memory = None
+
+    def shared_memory_name(self) -> str | None:
+        return None if self._shared_memory is None else self._shared_memory.name
 
-    def add(self, hash_key, score, move_number):
-        # right now, we automatically replace entry when hash collision occurs
-        self.table[hash_key] = MinimaxEntry(hash_key, score, move_number)
+    def get_age(self) -> int:
+        return self._age
 
-    def get(self, hash_key):
-        return self.table.get(hash_key, None)
+    def add(self, hash_key, score, depth, node_type: NodeType, best_move: chess.Move | None = None):
+        """
+        Stores a search result. Replacement scheme: an existing entry is kept only if it belongs to
+        a different position, comes from the current search (same age) and was searched deeper.
+        """
+        index = hash_key & self._index_mask
+        old_data = self._data[index]
+        if old_data:
+            same_position = self._keys[index] ^ old_data == hash_key
+            old_age = (old_data >> self._AGE_SHIFT) & self._AGE_MASK
+            old_depth = (old_data >> self._DEPTH_SHIFT) & 0xFF
+            if not same_position and old_age == self._age and old_depth > depth:
+                return
+            if same_position and best_move is None:
+                # keep the best move we already know about this position
+                best_move = self._decode_move((old_data >> self._MOVE_SHIFT) & 0xFFFF)
+        else:
+            self._num_filled += 1
+        data = self._pack(score, depth, node_type, best_move)
+        self._keys[index] = hash_key ^ data
+        self._data[index] = data
+
+    def get(self, hash_key) -> MinimaxEntry | None:
+        index = hash_key & self._index_mask
+        data = self._data[index]
+        if not data or self._keys[index] ^ data != hash_key:
+            return None
+        return MinimaxEntry(
+            key=hash_key,
+            score=self._decode_score(data & 0xFFFFFFFF),
+            depth=(data >> self._DEPTH_SHIFT) & 0xFF,
+            node_type=self._NODE_TYPES[(data >> self._TYPE_SHIFT) & 0x3],
+            best_move=self._decode_move((data >> self._MOVE_SHIFT) & 0xFFFF),
+            age=(data >> self._AGE_SHIFT) & self._AGE_MASK,
+        )
+
+    def new_search(self):
+        # Entries of earlier searches stay usable, but become preferred for replacement
+        self._age = (self._age + 1) & self._AGE_MASK
 
     def size(self):
-        return len(self.table)
+        if self._shared_memory is not None:
+            # other processes fill a shared table too, so count the occupied slots (empty slots have data 0)
+            return int(np.count_nonzero(np.frombuffer(self._data, dtype=np.uint64)))
+        return self._num_filled
+
+    def capacity(self):
+        return self._num_entries
 
     def clear(self):
-        # get rid of all entries
-        self.table = dict()
+        # get rid of all entries. Zeroes the buffer in place, so a shared table is cleared for all processes
+        self._buffer[:] = bytes(len(self._buffer))
+        self._num_filled = 0
+
+    """
+    Packing helpers
+    """
+    def _pack(self, score, depth, node_type: NodeType, best_move: chess.Move | None) -> int:
+        depth = min(max(depth, 0), 0xFF)
+        return (self._encode_score(score)
+                | depth << self._DEPTH_SHIFT
+                | node_type.value << self._TYPE_SHIFT
+                | self._encode_move(best_move) << self._MOVE_SHIFT
+                | self._age << self._AGE_SHIFT)
+
+    def _encode_score(self, score) -> int:
+        if score == math.inf:
+            centipawns = self._SCORE_INF
+        elif score == -math.inf:
+            centipawns = -self._SCORE_INF
+        else:
+            centipawns = min(max(round(score * self._SCORE_SCALE), 1 - self._SCORE_INF), self._SCORE_INF - 1)
+        return centipawns + self._SCORE_OFFSET
+
+    def _decode_score(self, stored: int) -> float:
+        centipawns = stored - self._SCORE_OFFSET
+        if centipawns >= self._SCORE_INF:
+            return math.inf
+        elif centipawns <= -self._SCORE_INF:
+            return -math.inf
+        return centipawns / self._SCORE_SCALE
+
+    @staticmethod
+    def _encode_move(move: chess.Move | None) -> int:
+        # from square (6 bits), to square (6 bits), promotion piece type (3 bits). 0 means no move
+        if not move:
+            return 0
+        return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+    @staticmethod
+    def _decode_move(encoded: int) -> chess.Move | None:
+        if encoded == 0:
+            return None
+        return chess.Move(encoded & 0x3F, (encoded >> 6) & 0x3F, (encoded >> 12) or None)
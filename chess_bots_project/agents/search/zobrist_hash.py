@@ -63,6 +63,14 @@ class ZobristHash:
 
         return board_hash
 
+    def compute_pawn_hash(self, board: chess.Board):
+        # Hash of the pawns only, the key of pawn structure evaluation terms
+        pawn_hash = 0
+        for color in chess.COLORS:
+            for square in board.pieces(chess.PAWN, color):
+                pawn_hash ^= self._piece_square_hash[(chess.PAWN, color, square)]
+        return pawn_hash
+
     def get_turn_hash(self):
         # returns the hash int that represent black's turn
         return self._black_turn_hash
@@ -6,19 +6,77 @@ Contains Zobrist hash of current position so it doesn't have to be computed from
 
 import chess
 from agents.search.zobrist_hash import ZobristHash
+from agents.evaluation import bitboard_eval
+from agents.evaluation import eval_func
+from agents.evaluation.eval_cache import EvalCache
+from agents.evaluation.pawn_hash_table import PawnHashTable
+from agents.evaluation.nnue_eval import NNUEEvaluator
+from agents.evaluation.piece_square_table import PieceSquareTable
 import timeit
 
 
 class HashBoard:
     """
-
+    Keeps the Zobrist hash of the position, and the material and piece-square scores used by the static
+    evaluation, up to date as moves are made and undone. Both are updated from the same list of piece changes.
+    In debug mode, every evaluate() call is cross-checked against a full recompute by eval_func.evaluate.
+    Evaluations are cached by position hash in eval_cache, by default the cache shared by all boards with the same
+    hasher (EvalCache.for_hasher).
+    A separate pawn key (hash of the pawns only) is kept alongside the position hash. Given a pawn_table,
+    evaluations include the pawn structure terms, looked up in the table by pawn key, and the king pawn shields.
+    Given an nnue evaluator, its first layer accumulator is kept up to date from the same piece changes, and
+    evaluations come from the network instead (with eval_func's checkmate / stalemate scores).
+    With use_activity, evaluations add bitboard_eval's mobility and king safety terms (bitboard_eval.evaluate).
+    The hashes of earlier positions are kept on a stack, with the number of plies since the last capture, pawn move
+    or null move, so repetitions and the fifty-move rule are detected without replaying the move stack.
     """
-    def __init__(self, board=chess.Board(), hasher=None):
+    # XORed into the evaluation cache key of evaluations with pawn structure terms, so they don't mix with the
+    # plain evaluations of other boards sharing the cache
+    PAWN_STRUCTURE_EVAL_KEY = 0x9E3779B97F4A7C15
+    STATIC_EVAL_KEY = 0xC2B2AE3D27D4EB4F  # same, for evaluations skipping the checkmate / stalemate tests
+    ACTIVITY_EVAL_KEY = 0x165667B19E3779F9  # same, for evaluations with mobility and king safety terms
+    FIFTY_MOVE_PLIES = 100
+    NNUE_TOLERANCE = 1e-6  # pawns; network outputs from the running accumulator and from scratch differ by rounding
+
+    def __init__(self, board=chess.Board(), hasher=None, debug=False, eval_cache=None,
+                 pawn_table: PawnHashTable = None, nnue: NNUEEvaluator = None, use_activity=False):
         self._board = board
         self._hasher = hasher
         if hasher is None:
             self._hasher = ZobristHash()
+        self._debug = debug
+        self._eval_cache = EvalCache.for_hasher(self._hasher) if eval_cache is None else eval_cache
         self._position_hash = self._hasher.compute_hash(self.get_deep_copy())
+        self._pawn_hash = self._hasher.compute_pawn_hash(self._board)
+        self._pawn_table = pawn_table
+        self._eval_key = 0 if pawn_table is None else self.PAWN_STRUCTURE_EVAL_KEY
+        if nnue is not None and pawn_table is not None:
+            raise RuntimeError("The NNUE evaluator has no pawn structure terms. Use either pawn_table or nnue!")
+        if nnue is not None and use_activity:
+            raise RuntimeError("The NNUE evaluator has no activity terms. Use either use_activity or nnue!")
+        self._use_activity = use_activity
+        if use_activity:
+            self._eval_key ^= self.ACTIVITY_EVAL_KEY
+        self._nnue = nnue
+        self._accumulator = None
+        if nnue is not None:
+            self._accumulator = nnue.new_accumulator(self._board)
+            self._eval_key = nnue.cache_key
+        # Running evaluation terms, from white's perspective in centipawns
+        self._material = eval_func.material_score(self._board)
+        self._position_score = eval_func.piece_position_score(self._board)
+        # For each move made, the piece changes applied, so undo_move can reverse exactly the same deltas
+        self._change_stack = []
+        # Hashes of the positions before each move, and for each position the number of plies it can be traced
+        # back without a capture, pawn move or null move, i.e. how far back a repetition can be.
+        # Earlier game positions are only needed as far back as the board's halfmove clock
+        self._hash_history = []
+        history_board = self.get_deep_copy()
+        for _ in range(min(board.halfmove_clock, len(board.move_stack))):
+            history_board.pop()
+            self._hash_history.append(self._hasher.compute_hash(history_board))
+        self._hash_history.reverse()
+        self._reversible_plies = [len(self._hash_history)]
 
     """
     Getter Methods
@@ -40,6 +98,120 @@ class HashBoard:
     def get_recomputed_hash(self):
         return self._hasher.compute_hash(self._board)
 
+    def get_pawn_hash(self):
+        return self._pawn_hash
+
+    def get_material_score(self):
+        return self._material
+
+    def get_position_score(self):
+        return self._position_score
+
+    def get_eval_cache(self) -> EvalCache:
+        return self._eval_cache
+
+    def get_pawn_table(self) -> PawnHashTable | None:
+        return self._pawn_table
+
+    def get_accumulator(self):
+        """
+        !!! WARNING: this returns the actual accumulator, NOT a copy !!!
+        None without an NNUE evaluator
+        """
+        return self._accumulator
+
+    """
+    Evaluation
+    """
+
+    def get_incremental_eval(self) -> float:
+        """
+        Material + piece-square evaluation from white's perspective in pawns, without checking for
+        checkmate or stalemate. Leaves out pawn structure and NNUE evaluations; evaluate(check_terminal=False)
+        is the full static evaluation
+        """
+        return (self._material + self._position_score) / eval_func.PAWN_ADVANTAGE
+
+    def evaluate(self, check_terminal=True) -> float:
+        """
+        Same result as eval_func.evaluate, but material and piece-square terms are read from the running totals,
+        and positions evaluated before are read from the evaluation cache (saving the checkmate / stalemate tests).
+        With a pawn table, same result as eval_func.evaluate(board, pawn_structure=True), with use_activity the
+        same as bitboard_eval.evaluate, and with an NNUE evaluator the same as its evaluate(board), but from the
+        running accumulator.
+        check_terminal=False skips the checkmate / stalemate tests (eval_func.static_evaluate), for searches that
+        detect the end of the game themselves when no legal move is generated
+        """
+        eval_key = self._position_hash ^ self._eval_key
+        if not check_terminal:
+            eval_key ^= self.STATIC_EVAL_KEY
+        evaluation = self._eval_cache.get(eval_key)
+        if evaluation is None:
+            if not check_terminal:
+                evaluation = self._static_eval()
+            elif self._board.is_checkmate():
+                evaluation = eval_func.CHECKMATE_SCORE if self._board.turn == chess.BLACK else -eval_func.CHECKMATE_SCORE
+            elif self._board.is_stalemate():
+                evaluation = 0
+            else:
+                evaluation = self._static_eval()
+            self._eval_cache.add(eval_key, evaluation)
+        if self._debug and self._nnue is not None:
+            if check_terminal:
+                recomputed = self._nnue.evaluate(self._board)
+            else:
+                recomputed = self._nnue.forward(self._nnue.new_accumulator(self._board))
+            if abs(evaluation - recomputed) > self.NNUE_TOLERANCE:
+                raise RuntimeError(f"Incremental NNUE evaluation {evaluation} differs from recomputed evaluation "
+                                   f"{recomputed} in position '{self._board.fen()}'")
+        elif self._debug:
+            pawn_structure = self._pawn_table is not None
+            evaluator = bitboard_eval if self._use_activity else eval_func
+            if check_terminal:
+                recomputed = evaluator.evaluate(self._board, pawn_structure=pawn_structure)
+            else:
+                recomputed = evaluator.static_evaluate(self._board, pawn_structure=pawn_structure)
+            if evaluation != recomputed:
+                raise RuntimeError(f"Incremental evaluation {evaluation} differs from recomputed evaluation "
+                                   f"{recomputed} in position '{self._board.fen()}'")
+        return evaluation
+
+    def _static_eval(self) -> float:
+        if self._nnue is not None:
+            return self._nnue.forward(self._accumulator)
+        score = self._material + self._position_score
+        if self._pawn_table is not None:
+            score += self._pawn_table.score(self._pawn_hash, self._board) + eval_func.pawn_shield_score(self._board)
+        if self._use_activity:
+            score += bitboard_eval.activity_score(self._board)
+        return score / eval_func.PAWN_ADVANTAGE
+
+    """
+    Draw detection
+    """
+
+    def is_repetition(self) -> bool:
+        """
+        Whether the position occurred before (once is enough), looking back only as far as the last capture,
+        pawn move or null move. Positions with the same side to move are at least 4 plies apart
+        """
+        history = self._hash_history
+        oldest = len(history) - self._reversible_plies[-1]
+        for index in range(len(history) - 4, oldest - 1, -2):
+            if history[index] == self._position_hash:
+                return True
+        return False
+
+    def is_fifty_moves(self) -> bool:
+        return self._board.halfmove_clock >= self.FIFTY_MOVE_PLIES
+
+    def is_draw(self) -> bool:
+        """
+        Draw by repetition, fifty-move rule or insufficient material. Cheap enough for every search node,
+        unlike outcome(), which replays the move stack. Checkmate and stalemate are not tested
+        """
+        return self.is_repetition() or self.is_fifty_moves() or self._board.is_insufficient_material()
+
     """
     MOVE-MAKING FUNCTIONS
     """
@@ -47,41 +219,23 @@ class HashBoard:
     def make_move(self, move: chess.Move):
         """
         Does not check legality of move
-        Assumes move is either legal or null. In case of null move, piece_type is None
+        Assumes move is either legal or null.
         """
-
-        origin_square = move.from_square
-        destination_square = move.to_square
-        color = self._board.turn
-        move_piece_type = self._board.piece_type_at(origin_square)
-        capture_piece_type = self._board.piece_type_at(destination_square)
-
-        # add hash (or undo) representing black's turn. It's the same operation
-        self._position_hash ^= self._hasher.get_turn_hash()
-        if move_piece_type is None:
-            # we assume move is null. Make the move and return
-            self._board.push(move)
-            return
-
-        # undo hash for location of piece moved
-        self._position_hash ^= self._hasher.get_piece_square_hash(move_piece_type, color, origin_square)
-        # undo hash for current castling rights
+        self._hash_history.append(self._position_hash)
+        # undo hash for current castling rights & en passant, if applicable. Null moves can change en passant too
         self._position_hash ^= self._hasher.get_castling_rights_hash(self._board.castling_rights)
-        # undo hash for en passant, if applicable
         if self._board.has_legal_en_passant():
             self._position_hash ^= self._hasher.get_en_passant_hash(self._board.ep_square)
+        # add hash (or undo) representing black's turn. It's the same operation
+        self._position_hash ^= self._hasher.get_turn_hash()
 
+        changes = self._get_piece_changes(move) if move else ()
         # NOW, MAKE THE MOVE
         self._board.push(move)
-
-        # add hash for piece at destination square
-        if move.promotion is not None:
-            self._position_hash ^= self._hasher.get_piece_square_hash(move.promotion, color, destination_square)
-        else:
-            self._position_hash ^= self._hasher.get_piece_square_hash(move_piece_type, color, destination_square)
-        # undo hash for captured piece, if any
-        if capture_piece_type is not None:
-            self._position_hash ^= self._hasher.get_piece_square_hash(capture_piece_type, not color, destination_square)
+        self._apply_piece_changes(changes, 1)
+        self._change_stack.append(changes)
+        # halfmove clock is reset by captures and pawn moves
+        self._reversible_plies.append(self._reversible_plies[-1] + 1 if move and self._board.halfmove_clock else 0)
 
         # Now we made the move, add hash for new castling rights, and new enpassant capture (if applicable)
         self._position_hash ^= self._hasher.get_castling_rights_hash(self._board.castling_rights)
@@ -90,7 +244,7 @@ class HashBoard:
 
     def undo_move(self):
         """
-        Undoes the last move and updates the current position hash accordingly
+        Undoes the last move and updates the current position hash and evaluation terms accordingly
         """
         # First, undo some hashing done by move; particularly, en passant & castling
         self._position_hash ^= self._hasher.get_castling_rights_hash(self._board.castling_rights)
@@ -101,34 +255,60 @@ class HashBoard:
         self._position_hash ^= self._hasher.get_turn_hash()
 
         # *** NOW, UNMAKE THE MOVE ***
-        move = self._board.pop()
+        self._board.pop()
+        self._apply_piece_changes(self._change_stack.pop(), -1)
+        self._reversible_plies.pop()
 
+        # redo hash for last move's castling rights & en passant, if applicable
+        self._position_hash ^= self._hasher.get_castling_rights_hash(self._board.castling_rights)
+        if self._board.has_legal_en_passant():
+            self._position_hash ^= self._hasher.get_en_passant_hash(self._board.ep_square)
+        self._hash_history.pop()
+
+    def _get_piece_changes(self, move: chess.Move) -> tuple:
+        """
+        Returns the pieces removed (-1) and added (+1) by a move, as (piece_type, color, square, sign) tuples.
+        Must be called before the move is pushed.
+        """
         origin_square = move.from_square
         destination_square = move.to_square
         color = self._board.turn
-        move_piece_type = self._board.piece_type_at(move.from_square)
+        move_piece_type = self._board.piece_type_at(origin_square)
         capture_piece_type = self._board.piece_type_at(destination_square)
 
-        if move_piece_type is None:
-            # we undid a null move
-            return
-
-        # undo hash for piece at destination square
-        if move.promotion is not None:
-            self._position_hash ^= self._hasher.get_piece_square_hash(move.promotion, color, destination_square)
-        else:
-            self._position_hash ^= self._hasher.get_piece_square_hash(move_piece_type, color, destination_square)
-        # redo hash for captured piece, if any
+        # piece leaves its origin square, and lands (possibly promoted) on the destination square
+        changes = [(move_piece_type, color, origin_square, -1),
+                   (move.promotion or move_piece_type, color, destination_square, 1)]
         if capture_piece_type is not None:
-            self._position_hash ^= self._hasher.get_piece_square_hash(capture_piece_type, not color, destination_square)
-
-        # redo hash for location of piece moved
-        self._position_hash ^= self._hasher.get_piece_square_hash(move_piece_type, color, origin_square)
-        # redo hash for last move's castling rights
-        self._position_hash ^= self._hasher.get_castling_rights_hash(self._board.castling_rights)
-        # redo hash for en passant, if applicable
-        if self._board.has_legal_en_passant():
-            self._position_hash ^= self._hasher.get_en_passant_hash(self._board.ep_square)
+            changes.append((capture_piece_type, not color, destination_square, -1))
+        elif move_piece_type == chess.PAWN and chess.square_file(origin_square) != chess.square_file(destination_square):
+            # en passant: captured pawn is beside the origin square, not on the destination square
+            captured_square = chess.square(chess.square_file(destination_square), chess.square_rank(origin_square))
+            changes.append((chess.PAWN, not color, captured_square, -1))
+        elif move_piece_type == chess.KING and abs(origin_square - destination_square) == 2:
+            # castling also moves the rook
+            rank = chess.square_rank(origin_square)
+            if destination_square > origin_square:
+                changes.append((chess.ROOK, color, chess.square(7, rank), -1))
+                changes.append((chess.ROOK, color, chess.square(5, rank), 1))
+            else:
+                changes.append((chess.ROOK, color, chess.square(0, rank), -1))
+                changes.append((chess.ROOK, color, chess.square(3, rank), 1))
+        return changes
+
+    def _apply_piece_changes(self, changes, direction: int):
+        # direction is 1 when making a move and -1 when undoing it. Hashing is its own inverse
+        for piece_type, color, square, sign in changes:
+            piece_square_hash = self._hasher.get_piece_square_hash(piece_type, color, square)
+            self._position_hash ^= piece_square_hash
+            if piece_type == chess.PAWN:
+                self._pawn_hash ^= piece_square_hash
+            perspective = direction * sign if color == chess.WHITE else -direction * sign
+            self._material += perspective * eval_func.PIECE_VALUES[piece_type]
+            # piece square table values for black are already negated
+            self._position_score += direction * sign * PieceSquareTable.read(piece_type, color, square)
+        if self._nnue is not None:
+            self._nnue.update(self._accumulator, changes, direction)
 
     """
     Board class functions
@@ -137,6 +317,9 @@ class HashBoard:
     def turn(self):
         return self._board.turn
 
+    def is_check(self):
+        return self._board.is_check()
+
     def outcome(self):
         return self._board.outcome()
 
@@ -0,0 +1,102 @@
+# Times eval_func and bitboard_eval on positions from random games, and checks that their material + piece-square
+# terms agree. bitboard_eval also scores mobility and king safety, so the totals differ.
+# Then checks that HashBoard with use_activity evaluates like bitboard_eval, and compares fixed depth MinimaxBot
+# searches with and without the activity terms.
+# Usage: python bitboard_eval_benchmark.py [num_positions] [seed] [search_depth]
+
+
+import contextlib
+import io
+import os
+import random
+import sys
+import timeit
+
+import chess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chess_bots_project"))
+
+from agents.evaluation import bitboard_eval, eval_func
+from agents.minimax_bot import MinimaxBot
+from playground.hash_board import HashBoard
+from playground.read_only_board import ReadOnlyBoard
+import playground.special_positions as special_positions
+
+
+REPEATS = 5
+SEARCH_FENS = [special_positions.STARTING_FEN, special_positions.TEST1,
+               "r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP3PPP/R2QKB1R w KQ - 0 9"]
+
+
+def random_positions(num_positions, seed) -> list:
+    # Positions after 0 to 80 random moves from the start position
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < num_positions:
+        board = chess.Board()
+        for _ in range(rng.randint(0, 80)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+        positions.append(board)
+    return positions
+
+
+def time_per_position(function, positions) -> float:
+    # Best of REPEATS runs over all positions, in microseconds per position
+    seconds = min(timeit.repeat(lambda: [function(position) for position in positions], number=1, repeat=REPEATS))
+    return 1e6 * seconds / len(positions)
+
+
+def check_hash_board(positions):
+    # HashBoard with use_activity must give bitboard_eval's scores, also after making and undoing moves
+    for position in positions:
+        hash_board = HashBoard(position.copy(), use_activity=True)
+        for move in [None] + list(position.legal_moves)[:4]:
+            if move is not None:
+                hash_board.make_move(move)
+            board = hash_board.get_shallow_copy()
+            if hash_board.evaluate() != bitboard_eval.evaluate(board):
+                raise RuntimeError(f"HashBoard and bitboard_eval scores differ in position '{board.fen()}'")
+            if move is not None:
+                hash_board.undo_move()
+
+
+def search(fen, depth, use_activity) -> (chess.Move, dict):
+    bot = MinimaxBot(max_depth=depth, use_activity=use_activity)
+    with contextlib.redirect_stdout(io.StringIO()):
+        best_move = bot.get_move(ReadOnlyBoard(chess.Board(fen)))
+    return best_move, bot.get_search_stats()
+
+
+def main():
+    num_positions = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    search_depth = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    positions = random_positions(num_positions, seed)
+    for position in positions:
+        expected = eval_func.material_score(position) + eval_func.piece_position_score(position)
+        if bitboard_eval.material_pst_score(position) != expected:
+            raise RuntimeError(f"Material + piece-square scores differ in position '{position.fen()}'")
+    print(f"*** {num_positions} positions, material + piece-square scores agree ***")
+    for name, function in (("eval_func.evaluate", eval_func.evaluate),
+                           ("bitboard_eval.evaluate", bitboard_eval.evaluate),
+                           ("eval_func.static_evaluate", eval_func.static_evaluate),
+                           ("bitboard_eval.static_evaluate", bitboard_eval.static_evaluate),
+                           ("bitboard_eval.material_pst_score", bitboard_eval.material_pst_score),
+                           ("bitboard_eval.activity_score", bitboard_eval.activity_score)):
+        print(f"{name}: {time_per_position(function, positions):.1f} us per position")
+
+    check_hash_board(positions)
+    print("*** HashBoard(use_activity=True) agrees with bitboard_eval.evaluate ***")
+    print(f"*** MinimaxBot searches to depth {search_depth} ***")
+    for fen in SEARCH_FENS:
+        for use_activity in (False, True):
+            best_move, stats = search(fen, search_depth, use_activity)
+            print(f"{fen[:30]:30} use_activity={use_activity!s:5}  move {best_move}  "
+                  f"{stats['nodes'] + stats['qnodes']:7} nodes  {stats['time']:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
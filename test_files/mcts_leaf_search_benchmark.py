@@ -0,0 +1,49 @@
+# Match between Monte Carlo bots scoring leaves with the static evaluation and with a shallow alpha-beta search
+# (quiescence only, and one ply plus quiescence), at the same time per move. Openings, colors and adjudication
+# are those of mcts_selection_benchmark. Before the match, every config is checked to play a move it searched.
+# Usage: python mcts_leaf_search_benchmark.py [seconds_per_move] [max_plies]
+
+
+import contextlib
+import io
+import sys
+
+import chess
+
+from mcts_selection_benchmark import match
+from agents.mtcs_bot import MonteCarloBot
+from playground.hash_board import HashBoard
+
+
+# Leaf searches rate the root above all of its searched moves here, which used to make unsearched moves look best
+CHECK_FEN = "r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP2BPPP/R2QKB1R w KQ - 0 8"
+CHECK_SIMS = 1000
+CONFIGS = {"static": dict(),
+           "quiescence": dict(leaf_search_depth=0),
+           "depth-1": dict(leaf_search_depth=1)}
+
+
+def check_searched_move(config, fen=CHECK_FEN, num_sim=CHECK_SIMS):
+    # Raises if the bot's best move in fen is not one of the root moves its search went through
+    bot = MonteCarloBot(seed=1, **config)
+    hash_board = HashBoard(chess.Board(fen), hasher=bot._zobrist_hasher)
+    with contextlib.redirect_stdout(io.StringIO()):
+        best_move, _, _ = bot.search(hash_board, num_sim=num_sim)
+    searched = bot.get_root_child_stats(hash_board)
+    if best_move.uci() not in searched:
+        raise RuntimeError(f"Played {best_move.uci()}, which was never searched (searched: {sorted(searched)})")
+
+
+def main():
+    time_per_move = float(sys.argv[1]) if len(sys.argv) > 1 else 0.2
+    max_plies = int(sys.argv[2]) if len(sys.argv) > 2 else 80
+    print(f"*** {time_per_move} seconds per move, games adjudicated after {max_plies} plies ***")
+    for config in CONFIGS.values():
+        check_searched_move(config)
+    print("All configs play searched moves.")
+    configs = {name: dict(config, time_limit=time_per_move) for name, config in CONFIGS.items()}
+    match(configs, "static", max_plies)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# Benchmark of parallel Monte Carlo tree search: simulations per second of the serial, root-parallel and
+# tree-parallel bots, and how often the parallel bots choose the same move as the serial one.
+# tree_small runs tree-parallel workers with batches on a tree that fills up: it searches each position twice, so the
+# second search starts from a full tree.
+# Usage: python mcts_parallel_benchmark.py [num_sim] [num_workers]
+
+
+import os
+import sys
+from timeit import default_timer
+
+import chess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chess_bots_project"))
+
+from agents.mtcs_bot import MonteCarloBot
+from playground.hash_board import HashBoard
+import playground.special_positions as positions
+
+
+FENS = [positions.STARTING_FEN, positions.TEST1,
+        "r1bqkbnr/p1pp1ppp/1pn5/4p3/2B1P3/5Q2/PPPP1PPP/RNB1K1NR w KQkq - 2 4",
+        "6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1"]
+
+
+def run(config, fen, num_sim, num_searches=1):
+    # Results of the last of num_searches searches from fen, the tree being kept between them
+    bot = MonteCarloBot(seed=0, **config)
+    hash_board = HashBoard(chess.Board(fen), hasher=bot._zobrist_hasher)
+    for _ in range(num_searches):
+        start_time = default_timer()
+        best_move, best_eval, stop_reason = bot.search(hash_board, num_sim=num_sim)
+        duration = default_timer() - start_time
+    bot.close()
+    return best_move, bot._num_sims / duration, stop_reason
+
+
+def main():
+    num_sim = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    num_workers = int(sys.argv[2]) if len(sys.argv) > 2 else max(2, os.cpu_count() or 1)
+    configs = {"serial": dict(use_array_tree=True),
+               "root": dict(use_array_tree=True, num_workers=num_workers, parallel_mode="root"),
+               "tree": dict(num_workers=num_workers, parallel_mode="tree"),
+               "tree_small": dict(num_workers=num_workers, parallel_mode="tree", max_tree_nodes=75 * num_workers,
+                                  batch_size=8)}
+    num_searches = {"tree_small": 2}
+    print(f"*** {num_sim} simulations, {num_workers} workers, {os.cpu_count()} cpus ***")
+    agreement = {name: 0 for name in configs}
+    for fen in FENS:
+        serial_move = None
+        for name, config in configs.items():
+            best_move, sims_per_sec, stop_reason = run(config, fen, num_sim, num_searches.get(name, 1))
+            if serial_move is None:
+                serial_move = best_move
+            agreement[name] += best_move == serial_move
+            print(f"{fen[:30]:30} {name:10} {sims_per_sec:8.0f} sims/sec  move {best_move}  ({stop_reason.value})")
+    for name in configs:
+        print(f"{name}: same move as serial in {agreement[name]} / {len(FENS)} positions")
+
+
+if __name__ == "__main__":
+    main()
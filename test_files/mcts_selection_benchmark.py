@@ -0,0 +1,73 @@
+# Match between Monte Carlo bots using Thompson sampling and PUCT selection, at the same number of simulations
+# per move. Each opening is played twice, with colors swapped. Games still going after max_plies are adjudicated
+# by static evaluation (a side more than ADJUDICATION_MARGIN pawns up wins).
+# Usage: python mcts_selection_benchmark.py [sims_per_move] [max_plies]
+
+
+import contextlib
+import io
+import os
+import sys
+
+import chess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chess_bots_project"))
+
+from agents.evaluation import eval_func
+from agents.mtcs_bot import MonteCarloBot
+from agents.search import move_order
+from playground.read_only_board import ReadOnlyBoard
+import playground.special_positions as positions
+
+
+OPENINGS = [positions.STARTING_FEN,
+            "r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3",
+            "rnbqkb1r/pp2pppp/3p1n2/8/3NP3/8/PPP2PPP/RNBQKB1R w KQkq - 1 5",
+            "rnbqkbnr/ppp1pppp/8/3p4/2PP4/8/PP2PPPP/RNBQKBNR b KQkq - 0 2"]
+ADJUDICATION_MARGIN = 1.0
+CONFIGS = {"thompson": dict(),
+           "puct": dict(selection_mode="puct"),
+           "puct-full-scores": dict(selection_mode="puct", move_prior=move_order.score_move)}
+
+
+def play(white_config, black_config, fen, max_plies) -> float:
+    # Returns white's score: 1 for a win, 0.5 for a draw, 0 for a loss. Configs include the search budget
+    bots = {chess.WHITE: MonteCarloBot(seed=1, **white_config), chess.BLACK: MonteCarloBot(seed=2, **black_config)}
+    board = chess.Board(fen)
+    for _ in range(max_plies):
+        if board.is_game_over(claim_draw=True):
+            break
+        with contextlib.redirect_stdout(io.StringIO()):
+            move = bots[board.turn].get_move(ReadOnlyBoard(board))
+        board.push(move)
+    outcome = board.outcome(claim_draw=True)
+    if outcome is not None:
+        return 0.5 if outcome.winner is None else float(outcome.winner == chess.WHITE)
+    evaluation = eval_func.evaluate(board)
+    if abs(evaluation) <= ADJUDICATION_MARGIN:
+        return 0.5
+    return float(evaluation > 0)
+
+
+def match(configs, baseline, max_plies):
+    # Plays every config against the baseline config, on every opening with both colors
+    for name, config in configs.items():
+        if name == baseline:
+            continue
+        score = 0.0
+        for fen in OPENINGS:
+            score += play(config, configs[baseline], fen, max_plies)
+            score += 1 - play(configs[baseline], config, fen, max_plies)
+        print(f"{name} vs {baseline}: {score} / {2 * len(OPENINGS)}")
+
+
+def main():
+    sims_per_move = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    max_plies = int(sys.argv[2]) if len(sys.argv) > 2 else 80
+    print(f"*** {sims_per_move} simulations per move, games adjudicated after {max_plies} plies ***")
+    configs = {name: dict(config, sim_limit=sims_per_move) for name, config in CONFIGS.items()}
+    match(configs, "thompson", max_plies)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# Benchmark of Thompson sampling selection in MonteCarloBot: one scipy.stats.beta.rvs draw per child (as before
+# TreeNode.select_child) against one vectorized numpy Generator.beta draw for all children. Times a single selection
+# at several branching factors, then simulations per second of whole searches with either selection.
+# Also checks that seeded searches reproduce.
+# Usage: python mcts_thompson_benchmark.py [num_sim] [num_searches]
+
+
+import contextlib
+import io
+import os
+import sys
+import timeit
+from timeit import default_timer
+
+import chess
+import numpy as np
+from scipy.stats import beta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chess_bots_project"))
+
+from agents.mtcs_bot import MonteCarloBot
+from agents.search.hash_tree import TreeNode
+from playground.hash_board import HashBoard
+import playground.special_positions as positions
+
+
+FENS = {"start": positions.STARTING_FEN, "TEST1": positions.TEST1}
+BRANCHING_FACTORS = (20, 35, 50)
+REPEATS = 5
+
+
+def scipy_select_child(node: TreeNode, rng: np.random.Generator) -> int:
+    # Selection as it was: children sampled one scipy call at a time, unexplored ones from node's own parameters
+    best_index, best_sample = None, -1
+    for index, state in enumerate(node.child_state.tolist()):
+        if state == TreeNode.DETERMINED:
+            continue
+        if state == TreeNode.UNEXPLORED:
+            sample = beta.rvs(node.param[0] + 1, node.param[1] + 1, random_state=rng)
+        else:
+            sample = beta.rvs(node.child_alpha[index], node.child_beta[index], random_state=rng)
+        if sample > best_sample:
+            best_index, best_sample = index, sample
+    if best_index is None:
+        best_index = int(rng.integers(len(node.moves)))
+    return best_index
+
+
+@contextlib.contextmanager
+def scipy_selection():
+    # MonteCarloBot's TreeNodes select with scipy_select_child while active
+    vectorized = TreeNode.select_child
+    TreeNode.select_child = scipy_select_child
+    try:
+        yield
+    finally:
+        TreeNode.select_child = vectorized
+
+
+def random_node(num_children, rng) -> TreeNode:
+    # Expanded node with a mix of unexplored and searched children
+    node = TreeNode(None, 0)
+    node.param = (20.0, 15.0)
+    node.expand([chess.Move.null()] * num_children, [0] * num_children, [None] * num_children)
+    searched = rng.random(num_children) < 0.5
+    node.child_alpha[searched] = rng.uniform(1, 10, searched.sum())
+    node.child_beta[searched] = rng.uniform(1, 10, searched.sum())
+    node.child_state[searched] = TreeNode.IN_TREE
+    return node
+
+
+def time_selection(select, node, rng) -> float:
+    # Best of REPEATS, in microseconds per selection
+    number = 200
+    return 1e6 * min(timeit.repeat(lambda: select(node, rng), number=number, repeat=REPEATS)) / number
+
+
+def run_search(fen, num_sim, seed=0) -> (chess.Move, float, float):
+    # (best move, eval, simulations per second) of a search from a fresh bot
+    bot = MonteCarloBot(seed=seed)
+    hash_board = HashBoard(chess.Board(fen), hasher=bot._zobrist_hasher)
+    start_time = default_timer()
+    with contextlib.redirect_stdout(io.StringIO()):
+        best_move, best_eval, _ = bot.search(hash_board, num_sim=num_sim)
+    return best_move, best_eval, bot._num_sims / (default_timer() - start_time)
+
+
+def main():
+    num_sim = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    num_searches = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    rng = np.random.default_rng(0)
+    print("*** One selection ***")
+    for num_children in BRANCHING_FACTORS:
+        node = random_node(num_children, rng)
+        scipy_time = time_selection(scipy_select_child, node, rng)
+        numpy_time = time_selection(TreeNode.select_child, node, rng)
+        print(f"{num_children} children: scipy per child {scipy_time:8.1f} us, vectorized {numpy_time:6.1f} us "
+              f"({scipy_time / numpy_time:.0f}x)")
+
+    print(f"*** Searches of {num_sim} simulations, best of {num_searches} ***")
+    for name, fen in FENS.items():
+        with scipy_selection():
+            scipy_speed = max(run_search(fen, num_sim)[2] for _ in range(num_searches))
+        numpy_speed = max(run_search(fen, num_sim)[2] for _ in range(num_searches))
+        print(f"{name}: scipy per child {scipy_speed:6.0f} sims/sec, vectorized {numpy_speed:6.0f} sims/sec "
+              f"({numpy_speed / scipy_speed:.1f}x)")
+
+    print("*** Seeded searches ***")
+    for name, fen in FENS.items():
+        first, second = run_search(fen, num_sim, seed=1)[:2], run_search(fen, num_sim, seed=1)[:2]
+        if first != second:
+            raise RuntimeError(f"Searches with the same seed differ from {name}: {first} and {second}")
+        print(f"{name}: same seed, same move and eval ({first[0]}, {first[1]:.3f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# Pawn hash table hit rates of MinimaxBot searches with pawn structure terms, over self-play games. The bot keeps
+# its pawn table between moves (one table per hasher), as it does when playing, so each search starts from the
+# structures of the previous ones. The first search of a game starts from an empty table and is reported apart.
+# Lookups only happen on evaluation cache misses, so every lookup is a position new to the search.
+# Usage: python pawn_hash_benchmark.py [num_moves] [seconds_per_search ...]
+
+
+import contextlib
+import io
+import os
+import sys
+
+import chess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chess_bots_project"))
+
+from agents.minimax_bot import MinimaxBot
+from playground.read_only_board import ReadOnlyBoard
+import playground.special_positions as positions
+
+
+POSITIONS = {"start": positions.STARTING_FEN,
+             "middlegame": "r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP3PPP/R2QKB1R w KQ - 0 9",
+             "tactical": "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+             "pawn endgame": "8/5pk1/6p1/3P4/2P2K2/8/6PP/8 w - - 0 1"}
+
+
+def play(fen, num_moves, seconds) -> list:
+    # (pawn table hits, misses) of each search of a self-play game of num_moves from fen
+    bot = MinimaxBot(use_pawn_structure=True, time_limit=seconds, max_depth=64)
+    board = chess.Board(fen)
+    counts = []
+    for _ in range(num_moves):
+        if board.is_game_over():
+            break
+        with contextlib.redirect_stdout(io.StringIO()):
+            move = bot.get_move(ReadOnlyBoard(board.copy()))
+        stats = bot.get_search_stats()
+        counts.append((stats["pawn_table_hits"], stats["pawn_table_misses"]))
+        board.push(move)
+    return counts
+
+
+def rate(hits, misses) -> str:
+    return f"{100 * hits / max(hits + misses, 1):.1f}%"
+
+
+def main():
+    num_moves = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    times = [float(arg) for arg in sys.argv[2:]] or [1.0, 5.0]
+    for seconds in times:
+        print(f"*** {num_moves} moves per game, {seconds} seconds per search ***")
+        total_hits, total_misses = 0, 0
+        for name, fen in POSITIONS.items():
+            counts = play(fen, num_moves, seconds)
+            hits = sum(hit for hit, _ in counts[1:])
+            misses = sum(miss for _, miss in counts[1:])
+            worst = min(counts[1:], key=lambda count: count[0] / max(sum(count), 1), default=(0, 0))
+            total_hits += hits
+            total_misses += misses
+            print(f"{name}: first search {rate(*counts[0])}, later searches {rate(hits, misses)} of "
+                  f"{hits + misses} lookups (lowest {rate(*worst)})")
+        print(f"all games, later searches: {rate(total_hits, total_misses)}")
+
+
+if __name__ == "__main__":
+    main()